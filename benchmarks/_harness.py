@@ -0,0 +1,23 @@
+"""
+Imports main.py without Firebase credentials so benchmarks can call its
+helpers directly. Firestore is replaced by whatever `db` is passed in.
+main.py's INFO logging is turned down to WARNING so it doesn't bury the
+benchmark output.
+"""
+import logging
+import os
+import sys
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def load_main(db=None):
+    with mock.patch("firebase_admin.credentials.Certificate"), \
+            mock.patch("firebase_admin.initialize_app"), \
+            mock.patch("firebase_admin.firestore.client", return_value=db or mock.MagicMock()):
+        import main
+    logging.getLogger().setLevel(logging.WARNING)
+    return main
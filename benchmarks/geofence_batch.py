@@ -0,0 +1,60 @@
+"""
+Geofence throughput: per-point is_inside_geofence vs the cached prepared
+geofence vs the vectorized batch path used by /mobile/geofence/verify-batch.
+
+    python benchmarks/geofence_batch.py [points ...]
+"""
+import math
+import random
+import sys
+import time
+
+import numpy as np
+
+from _harness import load_main
+
+
+def site_polygon(center_lat: float, center_lng: float, radius: float, vertices: int = 40):
+    return [
+        {
+            "lat": center_lat + radius * math.sin(2 * math.pi * i / vertices),
+            "lng": center_lng + radius * math.cos(2 * math.pi * i / vertices),
+        }
+        for i in range(vertices)
+    ]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main(sizes):
+    app = load_main()
+    coords = site_polygon(-33.8688, 151.2093, 0.005)
+    fence = app.PreparedGeofence(coords)
+    rng = random.Random(42)
+
+    print(f"{'points':>8} {'per-point':>14} {'prepared':>14} {'vectorized':>14}")
+    for n in sizes:
+        lats = [-33.8688 + rng.uniform(-0.01, 0.01) for _ in range(n)]
+        lngs = [151.2093 + rng.uniform(-0.01, 0.01) for _ in range(n)]
+        lat_arr = np.array(lats)
+        lng_arr = np.array(lngs)
+
+        naive, t_naive = timed(lambda: [app.is_inside_geofence(la, ln, coords) for la, ln in zip(lats, lngs)])
+        prepared, t_prepared = timed(lambda: [fence.contains(la, ln) for la, ln in zip(lats, lngs)])
+        vectorized, t_vector = timed(lambda: fence.contains_many(lat_arr, lng_arr).tolist())
+
+        assert naive == prepared == vectorized, "geofence paths disagree"
+        print(
+            f"{n:>8} "
+            f"{n / t_naive:>10.0f} p/s "
+            f"{n / t_prepared:>10.0f} p/s "
+            f"{n / t_vector:>10.0f} p/s"
+        )
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [100, 1_000, 10_000, 100_000])
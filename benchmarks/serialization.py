@@ -0,0 +1,114 @@
+"""
+List-route serialization cost: what FastAPI does with response_model
+(validate every document, dump it, render with the stdlib encoder) vs the
+trusted path that routes opt into with PageParams.respond(..., trusted=True)
+(project onto model fields, render with orjson). Reports wall and CPU time
+per request, then shows where the two paths disagree on documents that are
+not well-formed.
+
+    python benchmarks/serialization.py [rows ...]
+"""
+import json
+import platform
+import random
+import sys
+import time
+from typing import List
+
+import orjson
+import pydantic
+from pydantic import TypeAdapter
+
+from _harness import load_main
+
+REPEATS = 5
+
+
+def attendance_rows(n: int, rng: random.Random) -> List[dict]:
+    rows = []
+    for i in range(n):
+        day = f"2024-03-{rng.randint(1, 28):02d}"
+        rows.append({
+            "id": f"att{i}",
+            "attendanceId": f"att{i}",
+            "agencyId": "agency1",
+            "userId": f"user{rng.randint(1, 500)}",
+            "siteId": f"site{rng.randint(1, 40)}",
+            "shiftId": f"shift{i}",
+            "clockIn": f"{day}T08:{rng.randint(0, 59):02d}:00Z",
+            "clockOut": f"{day}T17:{rng.randint(0, 59):02d}:00Z",
+            "scheduledStart": f"{day}T08:00:00Z",
+            "hoursWorked": round(rng.uniform(6, 10), 2),
+            "overtimeHours": round(rng.uniform(0, 2), 2),
+            "breakPeriods": [{"breakStart": f"{day}T12:00:00Z", "breakEnd": f"{day}T12:30:00Z"}],
+            "lat": -33.8688 + rng.uniform(-0.01, 0.01),
+            "lng": 151.2093 + rng.uniform(-0.01, 0.01),
+            "createdAt": f"{day}T08:00:00Z",
+            "updatedAt": f"{day}T17:00:00Z",
+        })
+    return rows
+
+
+# Documents the trusted path does not treat like response_model does
+# as (field shown, how to corrupt a row, what of the field to show)
+MALFORMED = {
+    "missing required userId": ("userId", lambda row: row.pop("userId"), repr),
+    "hoursWorked stored as text": ("hoursWorked", lambda row: row.update(hoursWorked="8.5"), repr),
+    "extra key in breakPeriods": ("breakPeriods", lambda row: row["breakPeriods"][0].update(note="lunch"), lambda v: f"keys {sorted(v[0])}"),
+}
+
+
+def divergence(app, adapter, defaults, rng):
+    print(f"\n{'malformed document':<28} {'validated':<36} trusted")
+    for case, (field, corrupt, show) in MALFORMED.items():
+        row = attendance_rows(1, rng)[0]
+        corrupt(row)
+        try:
+            validated = show(adapter.dump_python(adapter.validate_python([row]), mode="json")[0][field])
+        except ValueError as e:  # pydantic's ValidationError; FastAPI answers 500
+            validated = f"500 ({e.errors()[0]['type']})"
+        trusted = show(app.project_trusted(row, defaults)[field])
+        assert validated != trusted, f"{case}: paths agree"
+        print(f"{case:<28} {validated:<36} {trusted}")
+
+
+def measure(fn):
+    best_wall = best_cpu = float("inf")
+    for _ in range(REPEATS):
+        wall, cpu = time.perf_counter(), time.process_time()
+        body = fn()
+        best_wall = min(best_wall, time.perf_counter() - wall)
+        best_cpu = min(best_cpu, time.process_time() - cpu)
+    return body, best_wall, best_cpu
+
+
+def main(sizes):
+    app = load_main()
+    adapter = TypeAdapter(List[app.Attendance])
+    defaults = app.model_field_defaults(app.Attendance)
+    rng = random.Random(42)
+
+    def validated(rows):
+        models = adapter.validate_python(rows)
+        return json.dumps(adapter.dump_python(models, mode="json")).encode()
+
+    def trusted(rows):
+        return app.FastJSONResponse([app.project_trusted(row, defaults) for row in rows]).body
+
+    print(f"python {platform.python_version()}, pydantic {pydantic.VERSION}, orjson {orjson.__version__}")
+    print(f"{'rows':>8} {'path':>10} {'wall ms':>10} {'cpu ms':>10} {'rows/s':>12}")
+    for n in sizes:
+        rows = attendance_rows(n, rng)
+        slow, slow_wall, slow_cpu = measure(lambda: validated(rows))
+        fast, fast_wall, fast_cpu = measure(lambda: trusted(rows))
+        assert json.loads(slow) == json.loads(fast), "serialization paths disagree"
+
+        for name, wall, cpu in (("validated", slow_wall, slow_cpu), ("trusted", fast_wall, fast_cpu)):
+            print(f"{n:>8} {name:>10} {wall * 1000:>10.1f} {cpu * 1000:>10.1f} {n / wall:>12.0f}")
+        print(f"{'':>8} {'speedup':>10} {slow_wall / fast_wall:>9.1f}x {slow_cpu / fast_cpu:>9.1f}x")
+
+    divergence(app, adapter, defaults, rng)
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [1_000, 10_000])
@@ -0,0 +1,266 @@
+"""
+Firestore round trips per mutation endpoint, with the current write helpers
+and with the previous ones (existence get before update/delete, re-read
+after update, separate update to stamp derived IDs) patched back in.
+
+    python benchmarks/write_rpcs.py
+"""
+import copy
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1 import types
+from google.cloud.firestore_v1.client import Client
+from fastapi import HTTPException
+
+from _harness import load_main
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data[field]
+
+
+class FakeQuery:
+    def __init__(self, db, path, filters=()):
+        self._db = db
+        self._path = path
+        self._filters = filters
+
+    def where(self, field, op, value):
+        return FakeQuery(self._db, self._path, self._filters + ((field, op, value),))
+
+    def order_by(self, *args, **kwargs):
+        return self
+
+    def limit(self, count):
+        return self
+
+    def select(self, fields):
+        return self
+
+    def stream(self):
+        self._db.rpcs["query"] += 1
+        prefix = self._path + "/"
+        for path, data in list(self._db.store.items()):
+            if not path.startswith(prefix) or "/" in path[len(prefix):]:
+                continue
+            if all(op != "==" or data.get(field) == value for field, op, value in self._filters):
+                yield FakeSnapshot(FakeDocRef(self._db, path), data)
+
+
+class FakeCollection(FakeQuery):
+    @property
+    def id(self):
+        return self._path.rsplit("/", 1)[-1]
+
+    def document(self, doc_id=None):
+        self._db.auto_ids += 1
+        return FakeDocRef(self._db, f"{self._path}/{doc_id or f'auto{self._db.auto_ids}'}")
+
+
+class FakeDocRef:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+        self.parent = FakeCollection(db, path.rsplit("/", 1)[0])
+
+    def collection(self, name):
+        return FakeCollection(self._db, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, **kwargs):
+        self._db.rpcs["get"] += 1
+        return FakeSnapshot(self, self._db.store.get(self.path))
+
+    def set(self, data, merge=False):
+        self._db.rpcs["write"] += 1
+        self._db.apply_set(self.path, data, merge)
+
+    def update(self, data):
+        self._db.rpcs["write"] += 1
+        self._db.check_exists(self.path)
+        self._db.store[self.path].update(data)
+
+    def delete(self, option=None):
+        self._db.rpcs["write"] += 1
+        self._db.check_precondition(self.path, option)
+        self._db.store.pop(self.path, None)
+
+
+class FakeBatch:
+    """Atomic like a real WriteBatch: a failed precondition rejects the whole commit."""
+
+    def __init__(self, db):
+        self._db = db
+        self._checks = []
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(lambda: self._db.apply_set(ref.path, data, merge))
+
+    def update(self, ref, data):
+        self._checks.append(lambda: self._db.check_exists(ref.path))
+        self._ops.append(lambda: self._db.store[ref.path].update(data))
+
+    def delete(self, ref, option=None):
+        self._checks.append(lambda: self._db.check_precondition(ref.path, option))
+        self._ops.append(lambda: self._db.store.pop(ref.path, None))
+
+    def commit(self):
+        self._db.rpcs["write"] += 1
+        for check in self._checks:
+            check()
+        for op in self._ops:
+            op()
+
+
+class FakeFirestore:
+    """In-memory Firestore that counts every RPC the app issues."""
+
+    def __init__(self):
+        self.store = {}
+        self.rpcs = Counter()
+        self.auto_ids = 0
+
+    def apply_set(self, path, data, merge):
+        if merge and path in self.store:
+            self.store[path].update(data)
+        else:
+            self.store[path] = dict(data)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    write_option = staticmethod(Client.write_option)
+
+    def check_exists(self, path):
+        if path not in self.store:
+            raise NotFound(f"No document to update: {path}")
+
+    def check_precondition(self, path, option):
+        """Applies a real WriteOption to a Write proto and enforces the precondition it sets."""
+        if option is None:
+            return
+        write = types.Write()
+        option.modify_write(write)
+        precondition = write._pb.current_document
+        if precondition.HasField("exists") and precondition.exists != (path in self.store):
+            raise NotFound(f"Precondition failed: {path}")
+
+    def get_all(self, refs, field_paths=None):
+        self.rpcs["get"] += 1
+        return [FakeSnapshot(ref, self.store.get(ref.path)) for ref in refs]
+
+
+def seed(db):
+    now = datetime.now(timezone.utc)
+    start = (now - timedelta(hours=8)).isoformat().replace("+00:00", "Z")
+    end = (now + timedelta(hours=1)).isoformat().replace("+00:00", "Z")
+    db.store.clear()
+    db.store.update({
+        "sites/site1": {
+            "siteId": "site1", "agencyId": "agency1", "name": "HQ", "description": "Head office",
+            "address": "1 Main St", "assignedHours": 40, "coordinates": [],
+        },
+        "shifts/shift1": {
+            "shiftId": "shift1", "agencyId": "agency1", "employeeId": "emp1", "siteId": "site1",
+            "shiftStart": start, "shiftEnd": end, "status": "pending",
+        },
+        "employees/emp1": {"name": "Sam", "agencyId": "agency1", "joinCode": "JOIN-EMP-AAAAAA"},
+        "attendance/att1": {
+            "attendanceId": "att1", "agencyId": "agency1", "userId": "emp1", "siteId": "site1",
+            "shiftId": "shift1", "clockIn": start, "breakPeriods": [],
+        },
+        "hourlyReports/report1": {"id": "report1", "agencyId": "agency1", "siteId": "site1", "userId": "emp1", "reportText": "ok"},
+    })
+
+
+def scenarios(app):
+    site = app.Site(agencyId="agency1", name="HQ 2", description="Head office", address="1 Main St", assignedHours=40)
+    return {
+        "PUT /v1/sites/{id}": lambda: app.update_site("site1", site, agency_id="agency1"),
+        "PATCH /v1/sites/{id}": lambda: app.partial_update_site("site1", site, agency_id="agency1"),
+        "DELETE /v1/sites/{id}": lambda: app.delete_site("site1", agency_id="agency1"),
+        "DELETE /v1/shifts/{id}": lambda: app.delete_shift("shift1", agency_id="agency1"),
+        "POST /v1/attendance/start-break": lambda: app.start_break("att1"),
+        "POST /v1/attendance/clockout": lambda: app.clock_out("att1"),
+        "PATCH /mobile/shifts/{id}/status": lambda: app.update_shift_status("shift1", app.ShiftStatus.confirmed, employee_id="emp1"),
+        "PATCH /v1/employees/{id}": lambda: app.update_employee_by_id("emp1", app.EmployeeModel(name="Sam", agencyId="agency1")),
+        "DELETE /v1/employees/{id}": lambda: app.delete_employee_by_id("emp1"),
+        "POST /web/hourly-reports": lambda: app.create_hourly_report(app.HourlyReport(agencyId="agency1", siteId="site1", userId="emp1", reportText="ok")),
+        "DELETE /web/hourly-reports/{id}": lambda: app.delete_hourly_report("report1", agency_id="agency1"),
+        "POST /web/employee/{id}/reset-join-code": lambda: app.regenerate_join_code("emp1"),
+    }
+
+
+def legacy_helpers(app, db):
+    """The write helpers as they were before round-trip minimizing."""
+
+    def add_document(collection, data, id_aliases=()):
+        saved = current_add(collection, data)
+        for alias in id_aliases:  # the old routes stamped these with a second update
+            db.collection(collection).document(saved["id"]).update({alias: saved["id"]})
+        return saved
+
+    def update_document(collection, doc_id, data, current=None, returning=True):
+        doc_ref = db.collection(collection).document(doc_id)
+        if not doc_ref.get().exists:
+            raise HTTPException(status_code=404, detail="not found")
+        data["updatedAt"] = datetime.utcnow().isoformat() + "Z"
+        doc_ref.update(data)
+        return doc_ref.get().to_dict()
+
+    def delete_document(collection, doc_id):
+        doc_ref = db.collection(collection).document(doc_id)
+        if not doc_ref.get().exists:
+            raise HTTPException(status_code=404, detail="not found")
+        doc_ref.delete()
+
+    current_add = app.add_document
+    return {"add_document": add_document, "update_document": update_document, "delete_document": delete_document}
+
+
+def count(app, db, run):
+    seed(db)
+    db.rpcs.clear()
+    run()
+    return sum(db.rpcs.values())
+
+
+def main():
+    db = FakeFirestore()
+    app = load_main(db)
+
+    current = {name: count(app, db, run) for name, run in scenarios(app).items()}
+
+    originals = {name: getattr(app, name) for name in ("add_document", "update_document", "delete_document")}
+    for name, helper in legacy_helpers(app, db).items():
+        setattr(app, name, helper)
+    try:
+        before = {name: count(app, db, run) for name, run in scenarios(app).items()}
+    finally:
+        for name, helper in originals.items():
+            setattr(app, name, helper)
+
+    print(f"{'endpoint':<42} {'before':>7} {'after':>7}")
+    for name in current:
+        print(f"{name:<42} {before[name]:>7} {current[name]:>7}")
+    print(f"{'total':<42} {sum(before.values()):>7} {sum(current.values()):>7}")
+
+
+if __name__ == "__main__":
+    main()
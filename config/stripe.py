@@ -1,26 +1,122 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 import stripe
+from fastapi import HTTPException
 from firebase_admin import firestore
 
 from dotenv import load_dotenv
 
+from config.cache import TTLCache
+
 load_dotenv()
 
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
+# Shared HTTP client: one keep-alive connection pool for every Stripe call,
+# bounded timeouts, and the library's idempotent retry on network errors
+STRIPE_TIMEOUT_SECONDS = float(os.getenv("STRIPE_TIMEOUT_SECONDS", "10"))
+STRIPE_POOL_SIZE = int(os.getenv("STRIPE_POOL_SIZE", "10"))
+stripe.max_network_retries = int(os.getenv("STRIPE_MAX_RETRIES", "2"))
+
+
+def _build_http_client():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=STRIPE_POOL_SIZE)
+    session.mount("https://", adapter)
+    client_cls = getattr(stripe, "RequestsClient", None) or stripe.http_client.RequestsClient
+    return client_cls(timeout=STRIPE_TIMEOUT_SECONDS, session=session)
+
+
+stripe.default_http_client = _build_http_client()
+
+def stripe_dict(obj) -> dict:
+    """
+    Plain, recursive dict copy of a Stripe object. From stripe 15 on,
+    StripeObject is no longer a dict subclass, so dict methods like .get()
+    must not be called on API results or webhook events directly.
+    """
+    return obj.to_dict() if isinstance(obj, stripe.StripeObject) else obj
+
+_stripe_executor = ThreadPoolExecutor(max_workers=STRIPE_POOL_SIZE, thread_name_prefix="stripe")
+
+
+class StripeLookups:
+    """
+    Per-request view of Stripe: customers are retrieved at most once, and
+    independent calls can be issued concurrently over the shared pool.
+    """
+
+    def __init__(self):
+        self._customers = {}
+        self._lock = threading.Lock()
 
+    def customer(self, customer_id: str):
+        with self._lock:
+            if customer_id in self._customers:
+                return self._customers[customer_id]
+        customer = stripe_dict(stripe.Customer.retrieve(customer_id))
+        with self._lock:
+            return self._customers.setdefault(customer_id, customer)
+
+    def fetch(self, **calls):
+        """Runs each zero-argument callable concurrently; returns {name: result}."""
+        futures = {name: _stripe_executor.submit(call) for name, call in calls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+# users/{uid}.stripeCustomerId never changes once set, so resolved IDs are
+# kept for a while; users without one are not cached
+stripe_customer_cache = TTLCache(
+    max_entries=int(os.getenv("STRIPE_CUSTOMER_CACHE_SIZE", "10000")),
+    ttl_seconds=float(os.getenv("STRIPE_CUSTOMER_CACHE_SECONDS", "900")),
+)
+
+
+def prime_stripe_customer_id(user_id: str, customer_id: str) -> None:
+    stripe_customer_cache.set(user_id, customer_id)
 
 
 def get_stripe_customer_id(user_id: str) -> str:
-    db = firestore.client()
-    doc_ref = db.collection("users").document(user_id)
-    doc = doc_ref.get()
+    customer_id = stripe_customer_cache.get(user_id)
+    if customer_id:
+        return customer_id
 
+    doc = firestore.client().collection("users").document(user_id).get(field_paths=["stripeCustomerId"])
     if not doc.exists:
-        raise Exception("User not found")
+        raise HTTPException(status_code=404, detail="User not found")
+
+    customer_id = (doc.to_dict() or {}).get("stripeCustomerId")
+    if not customer_id:
+        raise HTTPException(status_code=404, detail="Stripe customer ID not found")
+
+    prime_stripe_customer_id(user_id, customer_id)
+    return customer_id
+
+
+def get_stripe_customer_ids(user_ids) -> dict:
+    """
+    Resolves many users at once: {userId: customerId or None}. Cache misses
+    are read together with get_all instead of one round trip per user.
+    """
+    db = firestore.client()
+    resolved = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        customer_id = stripe_customer_cache.get(user_id)
+        if customer_id:
+            resolved[user_id] = customer_id
+        else:
+            missing.append(user_id)
 
-    data = doc.to_dict()
-    if "stripeCustomerId" not in data:
-        raise Exception("stripeCustomerId not set for user")
+    for i in range(0, len(missing), 500):
+        refs = [db.collection("users").document(user_id) for user_id in missing[i:i + 500]]
+        for doc in db.get_all(refs, field_paths=["stripeCustomerId"]):
+            customer_id = (doc.to_dict() or {}).get("stripeCustomerId") if doc.exists else None
+            if customer_id:
+                prime_stripe_customer_id(doc.id, customer_id)
+            resolved[doc.id] = customer_id
 
-    return data["stripeCustomerId"]
\ No newline at end of file
+    return resolved
@@ -7,23 +7,42 @@
 import logging
 from dotenv import load_dotenv
 load_dotenv()
+import firebase_admin
 import firebase_admin.messaging as messaging
 from typing import Annotated
 from enum import Enum
-from datetime import datetime
-from fastapi.responses import StreamingResponse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from fastapi.responses import StreamingResponse, JSONResponse
 from typing import Literal
-from fastapi import Header, Depends
+from fastapi import Header, Depends, Request
 from typing import List, Dict, Optional
 import io
+import copy
+from contextvars import ContextVar
+import orjson
+from functools import lru_cache
 from dateutil.parser import isoparse
 import csv
+import hashlib
+import queue
+import time
+import threading
+import bisect
+import zlib
 from firebase_admin import auth
-from fastapi import FastAPI, HTTPException, Query, Body, APIRouter
+from fastapi import FastAPI, HTTPException, Query, Body, APIRouter, Response, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from firebase_admin import credentials, initialize_app, firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import NotFound
+import numpy as np
+import shapely
 from shapely.geometry import Point, Polygon
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 from pydantic import BaseModel, constr
 from datetime import timezone
 from typing import Optional
@@ -33,6 +52,7 @@ import random
 from typing import List
 import string
 from routes.billing import router as billing_router
+from config.cache import TTLCache
 
 
 
@@ -62,74 +82,361 @@ db = firestore.client()
 # 2. Firestore Helper Functions
 #####################################################
 
-def get_stripe_customer_id(user_id: str) -> str:
-    db = firestore.client()
-    doc_ref = db.collection("users").document(user_id)
-    doc = doc_ref.get()
-
-    if not doc.exists:
-        raise Exception("User not found")
-
-    data = doc.to_dict()
-    if "stripeCustomerId" not in data:
-        raise Exception("stripeCustomerId not set for user")
-
-    return data["stripeCustomerId"]
-
-def add_document(collection: str, data: dict) -> dict:
+def add_document(collection: str, data: dict, id_aliases: tuple = ()) -> dict:
+    """id_aliases: extra fields (e.g. reportId) that also get the new document ID, in the same write."""
     doc_ref = db.collection(collection).document()
     id_field = "agencyId" if collection == "agencies" else "id"
     data[id_field] = doc_ref.id
+    for alias in id_aliases:
+        data[alias] = doc_ref.id
     now = datetime.utcnow().isoformat() + "Z"
     data["createdAt"] = now
     data["updatedAt"] = now
     logger.info(f"Adding document to {collection} with {id_field}: {doc_ref.id}")
     doc_ref.set(data)
+    identity_map = request_documents.get()
+    if identity_map is not None:
+        identity_map.remember(collection, doc_ref.id, data)
     return data
 
-def get_documents_by_field(collection: str, field: str, value: str) -> List[dict]:
-    logger.info(f"Querying {collection} where {field} = {value}")
-    docs = (
-        db.collection(collection).stream()
-        if field == "all"
-        else db.collection(collection).where(field, "==", value).stream()
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# Kill switch for the trusted path that routes opt into with
+# page.respond(..., trusted=True); see project_trusted for what it skips
+TRUSTED_LIST_RESPONSES = os.getenv("TRUSTED_LIST_RESPONSES", "1") != "0"
+MAX_PAGE_SIZE = 1000
+DEFAULT_PAGE_SIZE = 100
+
+
+class PageParams:
+    """
+    Pagination and projection for list routes. Without page_size or
+    start_after the whole result is returned as before; otherwise one page
+    comes back and the cursor for the next one is sent as X-Next-Cursor.
+    Requests with `Accept: application/x-ndjson` get one JSON document per
+    line, streamed as Firestore returns them.
+    Use as a dependency: `page: PageParams = Depends(PageParams)`.
+    """
+
+    def __init__(
+        self,
+        page_size: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+        start_after: Optional[str] = Query(None, description="X-Next-Cursor from the previous page"),
+        order_by: Literal["id", "createdAt"] = Query("id"),
+        fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+        accept: Optional[str] = Header(None)
+    ):
+        self.ndjson = NDJSON_MEDIA_TYPE in (accept or "")
+        self.page_size = page_size
+        self.start_after = start_after
+        self.order_by = order_by
+        self.fields = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+        self.next_cursor: Optional[str] = None
+
+    @property
+    def paginated(self) -> bool:
+        return self.page_size is not None or self.start_after is not None
+
+    def _encode_cursor(self, snap) -> str:
+        value = snap.get("createdAt") if self.order_by == "createdAt" else None
+        payload = orjson.dumps({"o": self.order_by, "v": value, "id": snap.id}, default=_json_default)
+        return base64.urlsafe_b64encode(payload).decode()
+
+    def _decode_cursor(self) -> dict:
+        try:
+            cursor = orjson.loads(base64.urlsafe_b64decode(self.start_after.encode()))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid start_after cursor")
+        if not isinstance(cursor, dict) or not isinstance(cursor.get("id"), str) or not cursor["id"]:
+            raise HTTPException(status_code=400, detail="Invalid start_after cursor")
+        if self.order_by == "createdAt" and "v" not in cursor:
+            raise HTTPException(status_code=400, detail="Invalid start_after cursor")
+        if cursor.get("o") != self.order_by:
+            raise HTTPException(status_code=400, detail="start_after cursor was issued for a different order_by")
+        return cursor
+
+    def apply(self, query, collection: str):
+        if self.fields:
+            paths = list(self.fields)
+            if self.paginated and self.order_by == "createdAt" and "createdAt" not in paths:
+                paths.append("createdAt")  # needed to build the next cursor
+            query = query.select(paths)
+        if not self.paginated:
+            return query
+
+        # Document ID breaks createdAt ties so pages never overlap or skip
+        if self.order_by == "createdAt":
+            query = query.order_by("createdAt")
+        query = query.order_by(FieldPath.document_id())
+
+        if self.start_after:
+            cursor = self._decode_cursor()
+            position = {FieldPath.document_id(): db.collection(collection).document(cursor["id"])}
+            if self.order_by == "createdAt":
+                position["createdAt"] = cursor["v"]
+            query = query.start_after(position)
+
+        return query.limit((self.page_size or DEFAULT_PAGE_SIZE) + 1)
+
+    def collect(self, snaps: list) -> list:
+        """Trims the look-ahead document and records the next cursor."""
+        limit = self.page_size or DEFAULT_PAGE_SIZE
+        if self.paginated and len(snaps) > limit:
+            snaps = snaps[:limit]
+            self.next_cursor = self._encode_cursor(snaps[-1])
+        return snaps
+
+    def respond(self, items, response: Response, model=None, trusted: bool = False):
+        """
+        Route return value for an iterable of documents. Projected rows and
+        NDJSON bypass response_model, which would reject partial documents
+        and needs the whole list up front. Full documents go through
+        response_model as usual, unless the route passes trusted=True: then
+        they are shaped to the model without validation (see project_trusted).
+        """
+        headers = {"X-Next-Cursor": self.next_cursor} if self.next_cursor else {}
+        trusted = trusted and TRUSTED_LIST_RESPONSES and model is not None
+        if self.ndjson:
+            # Same shape as the JSON response: projected fields as selected, else the route's model
+            if model is not None and not self.fields:
+                if trusted:
+                    defaults = model_field_defaults(model)
+                    items = (project_trusted(item, defaults) for item in items)
+                else:
+                    items = (model.model_validate(item).model_dump(mode="json") for item in items)
+            return StreamingResponse(ndjson_lines(items), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+        items = list(items)
+        logger.info(f"Returning {len(items)} documents")
+        if self.fields:
+            return FastJSONResponse(items, headers=headers)
+        if trusted:
+            defaults = model_field_defaults(model)
+            return FastJSONResponse([project_trusted(item, defaults) for item in items], headers=headers)
+        response.headers.update(headers)
+        return items
+
+
+def _json_default(value):
+    # Firestore timestamps arrive as datetime subclasses; anything else as text
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+@lru_cache(maxsize=None)
+def model_field_defaults(model) -> tuple:
+    """(name, default) for each field of a pydantic model; required fields default to None."""
+    return tuple(
+        (name, None if field.is_required() else field.get_default(call_default_factory=True))
+        for name, field in model.model_fields.items()
     )
 
-    result = []
+
+def project_trusted(doc: dict, defaults: tuple) -> dict:
+    """
+    What response_model would emit for a document we wrote ourselves, minus
+    the validation: model fields only, with defaults for the missing ones.
+    Only equivalent for well-formed documents. A missing required field
+    comes out as null instead of failing, values are not coerced ("8" stays
+    a string for an int field), and nested models such as breakPeriods are
+    passed through as stored, extra keys included. Routes opt in only for
+    collections written solely through their own models.
+    """
+    return {name: doc.get(name, default) for name, default in defaults}
+
+
+def ndjson_lines(docs):
     for doc in docs:
-        data = doc.to_dict()
+        yield orjson.dumps(doc, default=_json_default) + b"\n"
 
-        # 🔁 Inject Firestore document ID safely
-        if "id" not in data:
-            data["id"] = doc.id
 
-        result.append(data)
+def document_with_id(doc) -> dict:
+    data = doc.to_dict()
+    data["id"] = doc.id  # 🔥 Include Firestore document ID
+    return data
+
 
+def iter_documents_by_field(collection: str, field: str, value: str, page: Optional[PageParams] = None):
+    """
+    Lazy get_documents_by_field: unpaginated reads hold one document at a
+    time. A page is fetched eagerly so its cursor is known before the
+    response headers go out.
+    """
+    logger.info(f"Querying {collection} where {field} = {value}")
+    query = db.collection(collection) if field == "all" else db.collection(collection).where(field, "==", value)
+    if page is None:
+        snaps = query.stream()
+    elif page.paginated:
+        snaps = page.collect(list(page.apply(query, collection).stream()))
+    else:
+        snaps = page.apply(query, collection).stream()
+    return (document_with_id(doc) for doc in snaps)
+
+
+def get_documents_by_field(collection: str, field: str, value: str, page: Optional[PageParams] = None) -> List[dict]:
+    result = list(iter_documents_by_field(collection, field, value, page))
     logger.info(f"Found {len(result)} documents in {collection}")
     return result
 
+class DocumentIdentityMap:
+    """
+    Documents read or written during one request, keyed (collection, id),
+    so each is fetched at most once. None records a document known not to
+    exist. Readers get deep copies, so mutating a returned dict never changes
+    what the next reader sees. Code that writes without the helpers below
+    should forget() what it touched.
+    """
+    MISSING = object()
+
+    def __init__(self):
+        self._docs: Dict[tuple, Optional[dict]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, collection: str, doc_id: str):
+        """The cached document, None if known missing, or MISSING if never seen."""
+        key = (collection, doc_id)
+        if key not in self._docs:
+            self.misses += 1
+            return self.MISSING
+        self.hits += 1
+        data = self._docs[key]
+        return copy.deepcopy(data) if data is not None else None
+
+    def remember(self, collection: str, doc_id: str, data: Optional[dict]) -> None:
+        self._docs[(collection, doc_id)] = copy.deepcopy(data) if data is not None else None
+
+    def forget(self, collection: str, doc_id: str) -> None:
+        self._docs.pop((collection, doc_id), None)
+
+
+# Set per request by the document_identity_map middleware; None outside requests
+request_documents: ContextVar[Optional[DocumentIdentityMap]] = ContextVar("request_documents", default=None)
+
 def get_document_by_id(collection: str, doc_id: str) -> dict:
     if not doc_id:
         raise HTTPException(status_code=400, detail="Document ID is required")
-    logger.info(f"Fetching document from {collection} with ID: {doc_id}")
-    doc_ref = db.collection(collection).document(doc_id)
-    doc = doc_ref.get()
-    if not doc.exists:
+    identity_map = request_documents.get()
+    data = identity_map.lookup(collection, doc_id) if identity_map is not None else DocumentIdentityMap.MISSING
+    if data is DocumentIdentityMap.MISSING:
+        logger.info(f"Fetching document from {collection} with ID: {doc_id}")
+        doc = db.collection(collection).document(doc_id).get()
+        data = doc.to_dict() if doc.exists else None
+        if identity_map is not None:
+            identity_map.remember(collection, doc_id, data)
+    if data is None:
         logger.error(f"Document with ID {doc_id} not found in {collection}")
         raise HTTPException(status_code=404, detail=f"Document with ID {doc_id} not found in {collection}")
-    logger.info(f"Found document: {doc.to_dict()}")
-    return doc.to_dict()
+    logger.info(f"Found document: {data}")
+    return data
 
-def update_document(collection: str, doc_id: str, data: dict) -> dict:
+# Field values Firestore resolves server-side, so a local merge can't predict them
+FIRESTORE_TRANSFORMS = (firestore.Increment, firestore.ArrayUnion, firestore.ArrayRemove, type(firestore.SERVER_TIMESTAMP))
+
+def update_document(
+    collection: str,
+    doc_id: str,
+    data: dict,
+    current: Optional[dict] = None,
+    returning: bool = True
+) -> Optional[dict]:
+    """
+    update() already fails with NotFound on a missing document, so there is
+    no existence read. Pass `current` (the document as the caller already
+    read it) to get the result merged locally instead of re-read, or
+    returning=False when the result is not needed. Documents already read
+    in this request serve as `current` automatically.
+    """
     if not doc_id:
         raise HTTPException(status_code=400, detail="Document ID is required")
+    identity_map = request_documents.get()
+    if current is None and identity_map is not None:
+        cached = identity_map.lookup(collection, doc_id)
+        if cached is not DocumentIdentityMap.MISSING:
+            current = cached
     doc_ref = db.collection(collection).document(doc_id)
-    if not doc_ref.get().exists:
-        raise HTTPException(status_code=404, detail=f"Document with ID {doc_id} not found in {collection}")
     now = datetime.utcnow().isoformat() + "Z"
     data["updatedAt"] = now
-    doc_ref.update(data)
-    return doc_ref.get().to_dict()
+    try:
+        doc_ref.update(data)
+    except NotFound:
+        if identity_map is not None:
+            identity_map.remember(collection, doc_id, None)
+        raise HTTPException(status_code=404, detail=f"Document with ID {doc_id} not found in {collection}")
+
+    local_merge = current is not None and not any(
+        "." in key or isinstance(value, FIRESTORE_TRANSFORMS) for key, value in data.items()
+    )
+    if local_merge:
+        result = {**current, **data}
+    elif returning:
+        result = doc_ref.get().to_dict()
+    else:
+        result = None
+
+    if identity_map is not None:
+        if result is not None:
+            identity_map.remember(collection, doc_id, result)
+        else:
+            identity_map.forget(collection, doc_id)
+    return result if returning else None
+
+class DocumentLoader:
+    """
+    Request-scoped batch loader. Collects document IDs, fetches them with
+    db.get_all in chunks and memoizes them for the rest of the request.
+    Use as a dependency: `loader: DocumentLoader = Depends(DocumentLoader)`.
+    """
+    BATCH_SIZE = 100
+
+    def __init__(self):
+        self._cache: Dict[tuple, Optional[dict]] = {}
+
+    def prime_all(self, wanted: Dict[str, List[str]]) -> None:
+        identity_map = request_documents.get()
+        refs = []
+        for collection, ids in wanted.items():
+            for doc_id in dict.fromkeys(ids):
+                if not doc_id or (collection, doc_id) in self._cache:
+                    continue
+                cached = identity_map.lookup(collection, doc_id) if identity_map is not None else DocumentIdentityMap.MISSING
+                if cached is not DocumentIdentityMap.MISSING:
+                    self._cache[(collection, doc_id)] = cached
+                else:
+                    refs.append(db.collection(collection).document(doc_id))
+
+        for chunk in chunked(refs, self.BATCH_SIZE):
+            logger.info(f"Batch loading {len(chunk)} documents")
+            for snap in db.get_all(chunk):
+                key = (snap.reference.parent.id, snap.id)
+                self._cache[key] = snap.to_dict() if snap.exists else None
+                if identity_map is not None:
+                    identity_map.remember(*key, self._cache[key])
+
+    def prime(self, collection: str, ids: List[str]) -> None:
+        self.prime_all({collection: ids})
+
+    def load(self, collection: str, doc_id: str) -> dict:
+        if not doc_id:
+            raise HTTPException(status_code=400, detail="Document ID is required")
+        self.prime(collection, [doc_id])
+        doc = self._cache.get((collection, doc_id))
+        if doc is None:
+            logger.error(f"Document with ID {doc_id} not found in {collection}")
+            raise HTTPException(status_code=404, detail=f"Document with ID {doc_id} not found in {collection}")
+        return doc
+
+    def load_many(self, collection: str, ids: List[str]) -> Dict[str, dict]:
+        self.prime(collection, ids)
+        return {
+            doc_id: self._cache[(collection, doc_id)]
+            for doc_id in ids
+            if self._cache.get((collection, doc_id)) is not None
+        }
 
 def generate_unique_employee_join_code() -> str:
     for _ in range(10):
@@ -145,9 +452,13 @@ def delete_document(collection: str, doc_id: str):
     if not doc_id:
         raise HTTPException(status_code=400, detail="Document ID is required")
     doc_ref = db.collection(collection).document(doc_id)
-    if not doc_ref.get().exists:
+    try:
+        doc_ref.delete(option=db.write_option(exists=True))
+    except NotFound:
         raise HTTPException(status_code=404, detail=f"Document with ID {doc_id} not found in {collection}")
-    doc_ref.delete()
+    identity_map = request_documents.get()
+    if identity_map is not None:
+        identity_map.remember(collection, doc_id, None)
 
 def is_inside_geofence(user_lat: float, user_lng: float, polygon_coords: List[Dict[str, float]]) -> bool:
     polygon_points = [(p["lng"], p["lat"]) for p in polygon_coords]
@@ -155,6 +466,173 @@ def is_inside_geofence(user_lat: float, user_lng: float, polygon_coords: List[Di
     point = Point(user_lng, user_lat)
     return polygon.contains(point)
 
+
+class PreparedGeofence:
+    """A site polygon built once, prepared for repeated point tests, with its bounding box."""
+
+    def __init__(self, coordinates: List[Dict[str, float]], version: Optional[str] = None, site: Optional[dict] = None):
+        self.version = version
+        self.site = site or {}
+        self.loaded_at = time.monotonic()
+        self.polygon = None
+        self.prepared = None
+        self.bounds = None
+
+        if coordinates and len(coordinates) >= 3:
+            self.polygon = Polygon([(p["lng"], p["lat"]) for p in coordinates])
+            self.prepared = prep(self.polygon)
+            self.bounds = self.polygon.bounds  # (min lng, min lat, max lng, max lat)
+            shapely.prepare(self.polygon)  # vectorized predicates use the prepared tree
+
+    @property
+    def valid(self) -> bool:
+        return self.polygon is not None
+
+    def contains(self, lat: float, lng: float) -> bool:
+        if not self.valid:
+            return False
+        min_lng, min_lat, max_lng, max_lat = self.bounds
+        if not (min_lng <= lng <= max_lng and min_lat <= lat <= max_lat):
+            return False  # quick reject outside the bounding box
+        return self.prepared.contains(Point(lng, lat))
+
+    def contains_many(self, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+        """Vectorized contains for arrays of points; bounding-box rejects never reach GEOS."""
+        inside = np.zeros(len(lats), dtype=bool)
+        if not self.valid:
+            return inside
+
+        min_lng, min_lat, max_lng, max_lat = self.bounds
+        candidates = (lngs >= min_lng) & (lngs <= max_lng) & (lats >= min_lat) & (lats <= max_lat)
+        if not candidates.any():
+            return inside
+
+        inside[candidates] = shapely.contains_xy(self.polygon, lngs[candidates], lats[candidates])
+        return inside
+
+
+class GeofenceCache:
+    """
+    Bounded LRU of prepared geofences keyed by e.g. "sites/{id}" and
+    versioned by updatedAt. Callers pass the version they just read, so an
+    edit made by any worker is picked up on the next lookup; only the
+    polygon build is saved. max_age recycles entries that go unused.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_age_seconds: float = 300):
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self._entries: "OrderedDict[str, PreparedGeofence]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key: str) -> Optional[PreparedGeofence]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.loaded_at > self.max_age_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key: str, entry: PreparedGeofence) -> PreparedGeofence:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def get(self, key: str, version: Optional[str], coordinates: List[Dict[str, float]]) -> PreparedGeofence:
+        entry = self._lookup(key)
+        if entry is not None and entry.version == version:
+            return entry
+        return self._store(key, PreparedGeofence(coordinates, version))
+
+    def get_site(self, site_id: str) -> tuple:
+        """
+        (site, prepared geofence). The site document is read on every call,
+        so its metadata is current and the cached polygon is checked against
+        its updatedAt.
+        """
+        site = get_document_by_id("sites", site_id)
+        return site, self.get(f"sites/{site_id}", site.get("updatedAt"), site.get("coordinates", []))
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+geofence_cache = GeofenceCache()
+
+
+class SiteSpatialIndex:
+    """STRtree over one agency's site polygons for "which site contains this point" lookups."""
+
+    def __init__(self, sites: List[dict]):
+        self.fences = [
+            fence for fence in (
+                PreparedGeofence(site.get("coordinates", []), site.get("updatedAt"), site)
+                for site in sites
+            )
+            if fence.valid
+        ]
+        self.tree = STRtree([f.polygon for f in self.fences]) if self.fences else None
+        self.by_site = {f.site["id"]: f for f in self.fences}
+        self.built_at = time.monotonic()
+
+    def resolve(self, lat: float, lng: float) -> List[PreparedGeofence]:
+        if self.tree is None:
+            return []
+        hits = self.tree.query(Point(lng, lat), predicate="within")
+        return [self.fences[i] for i in hits]
+
+
+class SiteIndexRegistry:
+    """
+    Per-agency SiteSpatialIndex, built lazily and dropped on site writes in
+    this process; max_age bounds staleness from writes on other workers.
+    Bounded LRU over agencies. Each agency has a generation, bumped by
+    invalidate(), so a build that raced an invalidation is returned to its
+    caller but never cached.
+    """
+
+    def __init__(self, max_entries: int = 256, max_age_seconds: float = 300):
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self._indexes: "OrderedDict[str, SiteSpatialIndex]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, agency_id: str) -> SiteSpatialIndex:
+        with self._lock:
+            index = self._indexes.get(agency_id)
+            if index is not None and time.monotonic() - index.built_at <= self.max_age_seconds:
+                self._indexes.move_to_end(agency_id)
+                return index
+            generation = self._generations.get(agency_id, 0)
+
+        index = SiteSpatialIndex(get_documents_by_field("sites", "agencyId", agency_id))
+        with self._lock:
+            if self._generations.get(agency_id, 0) == generation:
+                self._indexes[agency_id] = index
+                self._indexes.move_to_end(agency_id)
+                while len(self._indexes) > self.max_entries:
+                    self._indexes.popitem(last=False)
+        return index
+
+    def resolve(self, agency_id: str, lat: float, lng: float) -> List[PreparedGeofence]:
+        return self.get(agency_id).resolve(lat, lng)
+
+    def invalidate(self, agency_id: str) -> None:
+        with self._lock:
+            self._indexes.pop(agency_id, None)
+            self._generations[agency_id] = self._generations.get(agency_id, 0) + 1
+
+
+site_index_registry = SiteIndexRegistry()
+
 def validate_geofence_coordinates(coordinates: List[Dict[str, float]]) -> None:
     if len(coordinates) < 3:
         raise HTTPException(status_code=400, detail="Geofence must have at least 3 coordinates to form a polygon")
@@ -174,24 +652,9 @@ def validate_geofence_coordinates(coordinates: List[Dict[str, float]]) -> None:
 
     #send push helper   
 
-def send_push(uid: str, title: str, body: str, data: dict = {}):
-    doc = db.collection("devices").document(uid).get()
-    if not doc.exists:
-        logger.warning(f"No device tokens found for {uid}")
-        return
-
-    tokens = doc.to_dict().get("tokens", [])
-    if not tokens:
-        return
-
-    message = messaging.MulticastMessage(
-        notification=messaging.Notification(title=title, body=body),
-        data=data,
-        tokens=tokens
-    )
-
-    response = messaging.send_multicast(message)
-    logger.info(f"Sent notification to {len(tokens)} devices: {response.success_count} success")
+def send_push(uid: str, title: str, body: str, data: dict = {}) -> bool:
+    # Delivery happens on the push dispatcher's worker, off the request thread
+    return push_dispatcher.enqueue([uid], title, body, data)
 
 
 def safe_parse_datetime(dt_str: str) -> datetime:
@@ -201,6 +664,117 @@ def safe_parse_datetime(dt_str: str) -> datetime:
         return None
 
 
+# Firestore caps "in" filters at 30 values per query
+FIRESTORE_IN_LIMIT = 30
+
+def chunked(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Background repairs queued or running on this worker, keyed e.g. ("dashboard", agencyId)
+_background_jobs_pending = set()
+_background_jobs_lock = threading.Lock()
+
+def queue_background_once(background_tasks: BackgroundTasks, key, fn, *args) -> None:
+    """Runs fn(*args) after the response, unless the same key is already queued on this worker."""
+    with _background_jobs_lock:
+        if key in _background_jobs_pending:
+            return
+        _background_jobs_pending.add(key)
+
+    def run():
+        try:
+            fn(*args)
+        except Exception as e:
+            logger.error(f"Background job {key} failed: {e}")
+        finally:
+            with _background_jobs_lock:
+                _background_jobs_pending.discard(key)
+
+    background_tasks.add_task(run)
+
+
+
+# Verified ID tokens keyed by token hash until they expire, plus short-lived
+# uid → agencyId / employee lookups so repeat calls skip Firestore
+token_cache = TTLCache(max_entries=20000, ttl_seconds=3600)
+user_agency_cache = TTLCache(max_entries=20000, ttl_seconds=300)
+user_employee_cache = TTLCache(max_entries=20000, ttl_seconds=300)
+
+def verify_id_token_cached(id_token: str) -> dict:
+    key = hashlib.sha256(id_token.encode("utf-8")).hexdigest()
+    decoded = token_cache.get(key)
+    if decoded is not None:
+        return decoded
+    decoded = auth.verify_id_token(id_token)
+    token_cache.set(key, decoded, expires_at=decoded.get("exp"))
+    return decoded
+
+# Misses are never cached: the cache is per worker, and a user who has just
+# signed up on another worker must not be refused until the entry expires.
+
+def resolve_user_agency_id(uid: str, decoded_token: Optional[dict] = None) -> Optional[str]:
+    """agencyId from the token's custom claims, else from users/{uid} (cached)."""
+    agency_id = (decoded_token or {}).get("agencyId")
+    if agency_id:
+        return agency_id
+    agency_id = user_agency_cache.get(uid)
+    if agency_id:
+        return agency_id
+    user_doc = db.collection("users").document(uid).get()
+    agency_id = user_doc.to_dict().get("agencyId") if user_doc.exists else None
+    if agency_id:
+        user_agency_cache.set(uid, agency_id)
+    return agency_id
+
+def resolve_user_employee(uid: str) -> Optional[dict]:
+    """
+    The employee linked to a uid. Only the uid -> employee ID mapping is
+    cached; the document itself is always read, so edits and deletes show
+    up at once and a mapping that no longer holds falls back to the query.
+    """
+    employee_id = user_employee_cache.get(uid)
+    if employee_id:
+        doc = db.collection("employees").document(employee_id).get()
+        employee = doc.to_dict() if doc.exists else None
+        if employee and employee.get("uid") == uid:
+            employee["id"] = doc.id
+            return employee
+        user_employee_cache.pop(uid)
+
+    employees = get_documents_by_field("employees", "uid", uid)
+    if not employees:
+        return None
+    user_employee_cache.set(uid, employees[0]["id"])
+    return employees[0]
+
+def invalidate_user_auth_cache(uid: str) -> None:
+    user_agency_cache.pop(uid)
+    user_employee_cache.pop(uid)
+
+def warm_token_verifier() -> None:
+    # Best effort, through the public API: an unsigned token with well-formed
+    # claims gets past verify_id_token's claim checks, so Google's signing
+    # certs are fetched into firebase_admin's cached session before the
+    # signature check rejects it
+    try:
+        project_id = firebase_admin.get_app().project_id
+        now = int(time.time())
+        segments = [
+            {"alg": "RS256", "kid": "warmup", "typ": "JWT"},
+            {
+                "aud": project_id, "iss": f"https://securetoken.google.com/{project_id}",
+                "sub": "warmup", "iat": now, "exp": now + 300, "auth_time": now
+            },
+        ]
+        token = ".".join(base64.urlsafe_b64encode(orjson.dumps(s)).rstrip(b"=").decode() for s in segments) + ".c2ln"
+        auth.verify_id_token(token)
+    except auth.InvalidIdTokenError:
+        logger.info("[Auth] ID token signing certificates warmed")
+    except Exception as e:
+        logger.warning(f"[Auth] Could not warm token verifier: {e}")
+
 
 #####################################################
 # 3. Pydantic Models
@@ -300,7 +874,7 @@ class Attendance(BaseModel):
     attendanceId: Optional[str] = None
     agencyId: str
     userId: str
-    siteId: str
+    siteId: Optional[str] = None  # clock-in resolves it from lat/lng when omitted
     clockIn: Optional[str] = None
     clockOut: Optional[str] = None
     scheduledStart: Optional[str] = None
@@ -325,6 +899,7 @@ class Message(BaseModel):
 class BroadcastMessage(BaseModel):
     siteId: str
     text: str
+    audience: Optional[Literal["clocked-in", "all"]] = "clocked-in"
 
 class HourlyReport(BaseModel):
     id: Optional[str] = None
@@ -332,6 +907,7 @@ class HourlyReport(BaseModel):
     siteId: str
     userId: str  # 👈 Needed to fetch employee-specific reports
     reportText: str
+    reportId: Optional[str] = None  # same value as id, kept for older clients
     createdAt: Optional[str] = None
     updatedAt: Optional[str] = None
     
@@ -378,6 +954,26 @@ class EmployeeModel(BaseModel):
 class EmployeeJoinCodeRegisterPayload(BaseModel):
     idToken: str
     joinCode: str
+
+
+class LocationPing(BaseModel):
+    userId: str
+    lat: float
+    lng: float
+    recordedAt: Optional[str] = None  # defaults to receipt time
+
+class LocationPingBatch(BaseModel):
+    pings: List[LocationPing]
+
+class GeofencePoint(BaseModel):
+    lat: float
+    lng: float
+    siteId: Optional[str] = None  # falls back to the request's siteId
+    id: Optional[str] = None  # caller's reference, echoed back
+
+class GeofenceBatchRequest(BaseModel):
+    siteId: Optional[str] = None
+    points: List[GeofencePoint]
    
 
 #####################################################
@@ -402,8 +998,35 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Doc-Cache-Hits"],
 )
 
+doc_cache_stats = {"requests": 0, "hits": 0, "misses": 0}
+doc_cache_stats_lock = threading.Lock()
+
+@app.middleware("http")
+async def document_identity_map(request: Request, call_next):
+    identity_map = DocumentIdentityMap()
+    token = request_documents.set(identity_map)
+    try:
+        response = await call_next(request)
+    finally:
+        request_documents.reset(token)
+    with doc_cache_stats_lock:
+        doc_cache_stats["requests"] += 1
+        doc_cache_stats["hits"] += identity_map.hits
+        doc_cache_stats["misses"] += identity_map.misses
+    response.headers["X-Doc-Cache-Hits"] = str(identity_map.hits)
+    return response
+
+@app.get("/dev/doc-cache/metrics")
+def get_doc_cache_metrics():
+    with doc_cache_stats_lock:
+        stats = dict(doc_cache_stats)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hitRate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+    return stats
+
 #####################################################
 
 
@@ -413,11 +1036,15 @@ app.include_router(billing_router)
 #####################################################
 
 
+@app.on_event("startup")
+def warm_auth():
+    warm_token_verifier()
+
+
 @app.post("/dev/create-stripe-customer")
 def create_stripe_customer(userId: str = Body(...), email: str = Body(...)):
     try:
-        import stripe
-        stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+        from config.stripe import stripe, prime_stripe_customer_id
 
         # 1. Create Stripe customer
         customer = stripe.Customer.create(email=email)
@@ -426,6 +1053,7 @@ def create_stripe_customer(userId: str = Body(...), email: str = Body(...)):
         db.collection("users").document(userId).set({
             "stripeCustomerId": customer.id
         }, merge=True)
+        prime_stripe_customer_id(userId, customer.id)
 
         return {
             "success": True,
@@ -440,15 +1068,11 @@ def create_stripe_customer(userId: str = Body(...), email: str = Body(...)):
 @app.post("/auth/login")
 def login_user(payload: LoginRequest):
     try:
-        decoded_token = auth.verify_id_token(payload.idToken)
+        decoded_token = verify_id_token_cached(payload.idToken)
         uid = decoded_token['uid']
 
         # Try to fetch agencyId from custom claims or fallback to Firestore user doc
-        agency_id = decoded_token.get("agencyId")
-        if not agency_id:
-            user_doc = db.collection("users").document(uid).get()
-            if user_doc.exists:
-                agency_id = user_doc.to_dict().get("agencyId")
+        agency_id = resolve_user_agency_id(uid, decoded_token)
 
         if not agency_id:
             raise HTTPException(status_code=400, detail="Agency ID not associated with user")
@@ -476,7 +1100,7 @@ def complete_signup(payload: CompleteSignupPayload):
         if payload.idToken.count('.') != 2:
             raise HTTPException(400, "Invalid Firebase ID token format")
 
-        decoded_token = auth.verify_id_token(payload.idToken)
+        decoded_token = verify_id_token_cached(payload.idToken)
         uid = decoded_token["uid"]
 
         # Check if this user already has an agency
@@ -493,6 +1117,7 @@ def complete_signup(payload: CompleteSignupPayload):
         db.collection("users").document(uid).set({
             "agencyId": new_agency["agencyId"]
         })
+        invalidate_user_auth_cache(uid)
 
         return {"message": "Signup complete", "agencyId": new_agency["agencyId"]}
 
@@ -508,14 +1133,11 @@ def get_agency_id(authorization: str = Header(...)) -> str:
         raise HTTPException(status_code=401, detail="Invalid token format")
     id_token = authorization.split(" ")[1]
     try:
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = verify_id_token_cached(id_token)
         uid = decoded_token["uid"]
-        agency_id = decoded_token.get("agencyId")
+        agency_id = resolve_user_agency_id(uid, decoded_token)
         if not agency_id:
-            user_doc = db.collection("users").document(uid).get()
-            if not user_doc.exists:
-                raise HTTPException(status_code=403, detail="User not linked to an agency")
-            agency_id = user_doc.to_dict().get("agencyId")
+            raise HTTPException(status_code=403, detail="User not linked to an agency")
         return agency_id
     except Exception as e:
         raise HTTPException(status_code=403, detail=f"Invalid token: {str(e)}")
@@ -524,16 +1146,13 @@ def get_agency_id(authorization: str = Header(...)) -> str:
 #####################################################
 
 @app.get("/v1/agencies", response_model=List[Agency])
-def read_agencies():
-    docs = db.collection("agencies").stream()
-    result = []
-    for doc in docs:
-        agency_data = doc.to_dict()
-        if "id" in agency_data and "agencyId" not in agency_data:
+def read_agencies(response: Response, page: PageParams = Depends(PageParams)):
+    def with_agency_id(agency_data: dict) -> dict:
+        if "agencyId" not in agency_data:
             agency_data["agencyId"] = agency_data.pop("id")
-        result.append(agency_data)
-    logger.info(f"Retrieved {len(result)} agencies")
-    return result
+        return agency_data
+
+    return page.respond(map(with_agency_id, iter_documents_by_field("agencies", "all", None, page)), response, Agency)
 
 @app.get("/v1/agencies/{agency_id}", response_model=Agency)
 def read_agency(agency_id: str):
@@ -552,16 +1171,15 @@ def create_agency(agency: AgencyCreate):
 #####################################################
 
 @app.get("/v1/sites", response_model=List[Site])
-def read_sites(agency_id: str = Query(...)):
-    sites = get_documents_by_field("sites", "agencyId", agency_id)
-
+def read_sites(response: Response, agency_id: str = Query(...), page: PageParams = Depends(PageParams)):
     # 🔁 Convert Firestore document ID to siteId so the Pydantic model picks it up
-    for site in sites:
+    def with_site_id(site: dict) -> dict:
         if "siteId" not in site:
             site["siteId"] = site["id"]  # ✅ Fix is here
+        return site
 
-    logger.info(f"Retrieved {len(sites)} sites for agency {agency_id}")
-    return sites
+    logger.info(f"Retrieving sites for agency {agency_id}")
+    return page.respond(map(with_site_id, iter_documents_by_field("sites", "agencyId", agency_id, page)), response, Site)
 
 
 @app.get("/v1/sites/{site_id}", response_model=Site)
@@ -577,6 +1195,8 @@ def read_site(site_id: str, agency_id: str = Query(...)):
 def create_site(site: Site):
     data = site.dict(exclude_unset=True)
     result = add_document("sites", data)
+    site_index_registry.invalidate(result["agencyId"])
+    set_dashboard_site_name(result["agencyId"], result["id"], result.get("name"))
     logger.info(f"Created site {result['id']} for agency {data['agencyId']}")
     return result
 
@@ -588,7 +1208,10 @@ def update_site(site_id: str, site: Site, agency_id: str = Query(...)):
         raise HTTPException(status_code=403, detail="Unauthorized")
     data = site.dict(exclude_unset=True)
     data["siteId"] = site_id
-    result = update_document("sites", site_id, data)
+    result = update_document("sites", site_id, data, current=existing_site)
+    geofence_cache.invalidate(f"sites/{site_id}")
+    site_index_registry.invalidate(agency_id)
+    set_dashboard_site_name(agency_id, site_id, result.get("name"))
     logger.info(f"Updated site {site_id} for agency {agency_id}")
     return result
 
@@ -599,7 +1222,10 @@ def partial_update_site(site_id: str, site: Site, agency_id: str = Query(...)):
         logger.warning(f"Unauthorized patch attempt to site {site_id} by agency {agency_id}")
         raise HTTPException(status_code=403, detail="Unauthorized")
     data = site.dict(exclude_unset=True, exclude_none=True)
-    result = update_document("sites", site_id, data)
+    result = update_document("sites", site_id, data, current=existing_site)
+    geofence_cache.invalidate(f"sites/{site_id}")
+    site_index_registry.invalidate(agency_id)
+    set_dashboard_site_name(agency_id, site_id, result.get("name"))
     logger.info(f"Partially updated site {site_id} for agency {agency_id}")
     return result
 
@@ -610,6 +1236,9 @@ def delete_site(site_id: str, agency_id: str = Query(...)):
         logger.warning(f"Unauthorized delete attempt to site {site_id} by agency {agency_id}")
         raise HTTPException(status_code=403, detail="Unauthorized")
     delete_document("sites", site_id)
+    geofence_cache.invalidate(f"sites/{site_id}")
+    site_index_registry.invalidate(agency_id)
+    drop_dashboard_site(agency_id, site_id)
     logger.info(f"Deleted site {site_id} for agency {agency_id}")
     return {"message": f"Site {site_id} deleted"}
 
@@ -617,13 +1246,166 @@ def delete_site(site_id: str, agency_id: str = Query(...)):
 # 7. Shift Endpoints
 #####################################################
 
+# Range queries look back this far so a window that starts mid-shift still
+# picks up the shift that is already running; longer shifts are rejected at
+# write time, since window queries could not see them
+MAX_SHIFT_DURATION = timedelta(hours=24)
+
+def parse_shift_utc(dt_str: str) -> datetime:
+    if dt_str.endswith("Z") and "+00:00" in dt_str:
+        dt_str = dt_str.replace("Z", "")
+    dt = datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+def shift_index_fields(shift_start: str, shift_end: str) -> dict:
+    """Sortable UTC fields stored on every shift so reads can be range-bounded."""
+    start = parse_shift_utc(shift_start)
+    end = parse_shift_utc(shift_end)
+    return {
+        "shiftStartEpoch": int(start.timestamp()),
+        "shiftEndEpoch": int(end.timestamp()),
+        "shiftDate": start.date().isoformat()
+    }
+
+def checked_shift_index_fields(shift_start, shift_end) -> dict:
+    """shift_index_fields for request input: bad or overlong times are a 400."""
+    try:
+        fields = shift_index_fields(shift_start, shift_end)
+    except (AttributeError, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="shiftStart and shiftEnd must be ISO 8601 datetimes")
+    duration = fields["shiftEndEpoch"] - fields["shiftStartEpoch"]
+    if duration <= 0:
+        raise HTTPException(status_code=400, detail="shiftEnd must be after shiftStart")
+    if duration > MAX_SHIFT_DURATION.total_seconds():
+        raise HTTPException(status_code=400, detail=f"Shifts cannot be longer than {MAX_SHIFT_DURATION.total_seconds() / 3600:g} hours")
+    return fields
+
+def with_shift_index(data: dict) -> dict:
+    """Adds the index fields to a shift about to be written."""
+    if data.get("shiftStart") and data.get("shiftEnd"):
+        data.update(checked_shift_index_fields(data["shiftStart"], data["shiftEnd"]))
+    return data
+
+def shift_query(agency_id: Optional[str] = None, employee_id: Optional[str] = None, site_id: Optional[str] = None):
+    query = db.collection("shifts")
+    if agency_id:
+        query = query.where("agencyId", "==", agency_id)
+    if employee_id:
+        query = query.where("employeeId", "==", employee_id)
+    if site_id:
+        query = query.where("siteId", "==", site_id)
+    return query
+
+def iter_shifts_by_date(start_date, end_date, **filters):
+    """Shifts whose UTC start date falls in [start_date, end_date]."""
+    query = shift_query(**filters) \
+        .where("shiftDate", ">=", start_date.isoformat()) \
+        .where("shiftDate", "<=", end_date.isoformat())
+    for doc in query.stream():
+        shift = doc.to_dict()
+        shift["id"] = doc.id
+        yield shift
+
+def iter_shifts_in_window(start: datetime, end: datetime, **filters):
+    """Shifts overlapping [start, end]; naive datetimes are treated as UTC."""
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    start_epoch = int(start.timestamp())
+    end_epoch = int(end.timestamp())
+
+    query = shift_query(**filters) \
+        .where("shiftStartEpoch", ">=", start_epoch - int(MAX_SHIFT_DURATION.total_seconds())) \
+        .where("shiftStartEpoch", "<=", end_epoch)
+    for doc in query.stream():
+        shift = doc.to_dict()
+        if shift.get("shiftEndEpoch", 0) < start_epoch:
+            continue
+        shift["id"] = doc.id
+        yield shift
+
+def backfill_shift_index(agency_id: Optional[str] = None) -> dict:
+    """
+    Stamps shiftStartEpoch/shiftEndEpoch/shiftDate onto shifts written before
+    the index existed. Runs once per database on startup (see
+    run_shift_index_migration); the /dev endpoint reruns it on demand.
+    Shifts longer than MAX_SHIFT_DURATION are indexed but counted as
+    "overlong", since window queries can miss them.
+    """
+    batch = db.batch()
+    pending = 0
+    updated = 0
+    skipped = 0
+    overlong = 0
+
+    for doc in shift_query(agency_id=agency_id).stream():
+        data = doc.to_dict()
+        try:
+            fields = shift_index_fields(data["shiftStart"], data["shiftEnd"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            skipped += 1
+            continue
+        if fields["shiftEndEpoch"] - fields["shiftStartEpoch"] > MAX_SHIFT_DURATION.total_seconds():
+            overlong += 1
+
+        if all(data.get(k) == v for k, v in fields.items()):
+            continue
+
+        batch.update(doc.reference, fields)
+        pending += 1
+        updated += 1
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+
+    logger.info(f"Shift index backfill: {updated} updated, {skipped} skipped, {overlong} overlong")
+    if overlong:
+        logger.warning(f"Shift index backfill: {overlong} shifts exceed {MAX_SHIFT_DURATION} and may be missed by window queries")
+    return {"updated": updated, "skipped": skipped, "overlong": overlong}
+
+def run_shift_index_migration() -> None:
+    """
+    Backfills the shift index once per database. The first worker to create
+    migrations/shift-index runs it; a failed run deletes the marker so the
+    next startup retries.
+    """
+    from google.api_core.exceptions import AlreadyExists
+    marker = db.collection("migrations").document("shift-index")
+    try:
+        marker.create({"startedAt": datetime.utcnow().isoformat() + "Z"})
+    except AlreadyExists:
+        return
+    try:
+        result = backfill_shift_index()
+        marker.update({"completedAt": datetime.utcnow().isoformat() + "Z", **result})
+    except Exception as e:
+        logger.error(f"Shift index migration failed: {e}")
+        marker.delete()
+
+@app.on_event("startup")
+def start_shift_index_migration():
+    threading.Thread(target=run_shift_index_migration, name="shift-index-migration", daemon=True).start()
+
+@app.post("/dev/migrations/shift-index")
+def run_shift_index_backfill(agency_id: Optional[str] = Query(None)):
+    return {"success": True, **backfill_shift_index(agency_id)}
+
 @app.get("/v1/shifts", response_model=List[Shift])
-def read_shifts(agency_id: str = Query(...)):
-    return get_documents_by_field("shifts", "agencyId", agency_id)
+def read_shifts(response: Response, agency_id: str = Query(...), page: PageParams = Depends(PageParams)):
+    return page.respond(iter_documents_by_field("shifts", "agencyId", agency_id, page), response, Shift, trusted=True)
 
 @app.post("/v1/shifts", response_model=Shift)
 def create_shift(shift: Shift):
-    return add_document("shifts", shift.dict(exclude_unset=True))
+    result = add_document("shifts", with_shift_index(shift.dict(exclude_unset=True)))
+    rollup_scheduled_shift(result)
+    return result
 
 @app.delete("/v1/shifts/{shift_id}")
 def delete_shift(shift_id: str, agency_id: str = Query(...)):
@@ -631,6 +1413,7 @@ def delete_shift(shift_id: str, agency_id: str = Query(...)):
     if shift.get("agencyId") != agency_id:
         raise HTTPException(status_code=403, detail="Unauthorized")
     delete_document("shifts", shift_id)
+    unschedule_shift(shift, shift_id=shift_id)
     return {"message": f"Shift {shift_id} deleted"}
 
 #####################################################
@@ -638,8 +1421,8 @@ def delete_shift(shift_id: str, agency_id: str = Query(...)):
 #####################################################
 
 @app.get("/v1/leave-requests", response_model=List[LeaveRequest])
-def read_leave_requests(agency_id: str = Query(...)):
-    return get_documents_by_field("leaveRequests", "agencyId", agency_id)
+def read_leave_requests(response: Response, agency_id: str = Query(...), page: PageParams = Depends(PageParams)):
+    return page.respond(iter_documents_by_field("leaveRequests", "agencyId", agency_id, page), response, LeaveRequest)
 
 @app.post("/v1/leave-requests", response_model=LeaveRequest)
 def create_leave_request(leave_req: LeaveRequest):
@@ -650,8 +1433,8 @@ def create_leave_request(leave_req: LeaveRequest):
 #####################################################
 
 @app.get("/v1/incidents", response_model=List[Incident])
-def read_incidents(agency_id: str = Query(...)):
-    return get_documents_by_field("incidents", "agencyId", agency_id)
+def read_incidents(response: Response, agency_id: str = Query(...), page: PageParams = Depends(PageParams)):
+    return page.respond(iter_documents_by_field("incidents", "agencyId", agency_id, page), response, Incident)
 
 @app.post("/v1/incidents", response_model=Incident)
 def create_incident(incident: Incident):
@@ -722,61 +1505,308 @@ from firebase_admin import firestore
 
 
 
-@app.post("/v1/attendance/mark-absentees")
-def mark_absentees(
-    date: str = Query(..., description="Date in YYYY-MM-DD format"),
-    agency_id: str = Query(...)
-):
-    try:
-        target_date = datetime.fromisoformat(date).date()
-    except ValueError:
-        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+def attendance_rollup_ref(agency_id: str, day: str):
+    return db.collection("attendanceRollups").document(f"{agency_id}_{day}")
 
-    now = datetime.now(timezone.utc)
-    marked = []
 
-    # Fetch shifts for the date and agency
-    shifts = db.collection("shifts").where("agencyId", "==", agency_id).stream()
+def bump_attendance_rollup(
+    agency_id: str,
+    day: str,
+    present: Optional[str] = None,
+    late: int = 0,
+    overtime: float = 0,
+    absent: List[str] = (),
+    scheduled: Optional[Dict[str, Optional[str]]] = None,
+    batch=None
+) -> None:
+    """
+    Applies an incremental change to the agency's rollup for `day` using
+    Increment/ArrayUnion, so concurrent writers never overwrite each other.
+    `scheduled` maps shiftId to its employee, or to None to drop the shift.
+    Pass a batch to commit the change together with the write that caused it.
+    The merge never sets rebuiltAt, so a document that only holds deltas is
+    still rebuilt before it is read.
+    """
+    changes = {
+        "agencyId": agency_id,
+        "date": day,
+        "updatedAt": datetime.utcnow().isoformat() + "Z"
+    }
+    if present:
+        changes["presentUserIds"] = firestore.ArrayUnion([present])
+    if late:
+        changes["lateCount"] = firestore.Increment(late)
+    if overtime:
+        changes["overtimeHours"] = firestore.Increment(overtime)
+    if absent:
+        changes["absentUserIds"] = firestore.ArrayUnion(list(absent))
+        changes["absentCount"] = firestore.Increment(len(absent))
+    if scheduled:
+        changes["scheduledShifts"] = {
+            shift_id: employee_id or firestore.DELETE_FIELD
+            for shift_id, employee_id in scheduled.items()
+        }
 
-    for shift_doc in shifts:
-        shift = shift_doc.to_dict()
-        shift_id = shift_doc.id
+    ref = attendance_rollup_ref(agency_id, day)
+    if batch is not None:
+        batch.set(ref, changes, merge=True)
+    else:
+        ref.set(changes, merge=True)
 
-        shift_start = datetime.fromisoformat(shift["shiftStart"].replace("Z", "+00:00"))
-        shift_end = datetime.fromisoformat(shift["shiftEnd"].replace("Z", "+00:00"))
 
-        if shift_start.date() != target_date:
+def rollup_scheduled_shift(shift: dict, batch=None, shift_id: Optional[str] = None, previous: Optional[dict] = None) -> None:
+    """
+    Records the shift's employee under scheduledShifts for its day. Pass the
+    shift as it was before an update as `previous`, so a move to another
+    day leaves nothing behind on the old one.
+    """
+    shift_id = shift_id or shift.get("id")
+    if not shift_id:
+        return
+    if previous and previous.get("shiftDate") and previous.get("shiftDate") != shift.get("shiftDate"):
+        unschedule_shift(previous, batch=batch, shift_id=shift_id)
+    if shift.get("agencyId") and shift.get("shiftDate"):
+        bump_attendance_rollup(shift["agencyId"], shift["shiftDate"], scheduled={shift_id: shift.get("employeeId")}, batch=batch)
+
+
+def unschedule_shift(shift: dict, batch=None, shift_id: Optional[str] = None) -> None:
+    shift_id = shift_id or shift.get("id")
+    if shift_id and shift.get("agencyId") and shift.get("shiftDate"):
+        bump_attendance_rollup(shift["agencyId"], shift["shiftDate"], scheduled={shift_id: None}, batch=batch)
+
+
+def rebuild_attendance_rollups(agency_id: str, start_date, end_date) -> Dict[str, dict]:
+    """
+    Recomputes the rollups for [start_date, end_date] from raw shifts and
+    attendance. Runs from the /dev endpoint or a background task, not inline
+    in a read.
+
+    Each stored document is corrected rather than overwritten: counters get
+    Increment(recomputed - stored), the ID arrays lose stale IDs with
+    ArrayRemove and gain missing ones with ArrayUnion, and scheduledShifts
+    entries are set or deleted one by one. Deltas that bump_attendance_rollup
+    merges in between the read below and the commit are kept.
+    """
+    days: Dict[str, dict] = {}
+
+    def day_rollup(day: str) -> dict:
+        return days.setdefault(day, {
+            "agencyId": agency_id,
+            "date": day,
+            "presentUserIds": set(),
+            "lateCount": 0,
+            "overtimeHours": 0,
+            "absentUserIds": set(),
+            "scheduledShifts": {}
+        })
+
+    d = start_date
+    while d <= end_date:
+        day_rollup(d.isoformat())
+        d += timedelta(days=1)
+
+    shift_dates = {}
+    for shift in iter_shifts_by_date(start_date, end_date, agency_id=agency_id):
+        shift_dates[shift["id"]] = shift["shiftDate"]
+        if shift.get("employeeId"):
+            day_rollup(shift["shiftDate"])["scheduledShifts"][shift["id"]] = shift["employeeId"]
+
+    for shift_id, record in fetch_attendance_by_shift_ids(list(shift_dates)).items():
+        if record.get("status") == "absent":
+            day_rollup(shift_dates[shift_id])["absentUserIds"].add(record["userId"])
+
+    attendance = db.collection("attendance") \
+        .where("agencyId", "==", agency_id) \
+        .where("clockIn", ">=", start_date.isoformat()) \
+        .where("clockIn", "<", (end_date + timedelta(days=1)).isoformat()) \
+        .stream()
+
+    for att_doc in attendance:
+        att = att_doc.to_dict()
+        clock_in = safe_parse_datetime(att.get("clockIn"))
+        if not clock_in:
             continue
 
-        if now < shift_end:
-            continue  # Shift not yet over
-
-        # Check if any attendance exists
-        existing_attendance = db.collection("attendance") \
-            .where("shiftId", "==", shift_id) \
-            .limit(1).stream()
-
-        if any(existing_attendance):
-            continue  # Already present or marked
-
-        # Create absent record
-        timestamp = now.isoformat().replace("+00:00", "Z")
-        absent_record = {
-            "agencyId": shift["agencyId"],
-            "userId": shift["employeeId"],
-            "siteId": shift["siteId"],
-            "shiftId": shift_id,
-            "status": "absent",
-            "clockIn": None,
-            "clockOut": None,
-            "hoursWorked": 0,
-            "overtimeHours": 0,
-            "createdAt": timestamp,
-            "updatedAt": timestamp
+        rollup = day_rollup(clock_in.date().isoformat())
+        rollup["presentUserIds"].add(att["userId"])
+        rollup["overtimeHours"] += att.get("overtimeHours", 0) or 0
+
+        scheduled_start = safe_parse_datetime(att.get("scheduledStart"))
+        if scheduled_start and clock_in > scheduled_start:
+            rollup["lateCount"] += 1
+
+    now = datetime.utcnow().isoformat() + "Z"
+    refs = {day: attendance_rollup_ref(agency_id, day) for day in days}
+    stored = {}
+    for chunk in chunked(list(refs.values()), 500):
+        for snap in db.get_all(chunk):
+            stored[snap.id] = snap.to_dict() if snap.exists else {}
+
+    batch = db.batch()
+    pending = 0
+    for day, rollup in days.items():
+        ref = refs[day]
+        current = stored.get(ref.id) or {}
+        present = sorted(rollup["presentUserIds"])
+        absent = sorted(rollup["absentUserIds"])
+
+        # Firestore allows one transform per field per write, so stale IDs go
+        # in a first write; both commit atomically in the same batch
+        stale = {
+            field: sorted(set(current.get(field) or []) - ids)
+            for field, ids in (("presentUserIds", rollup["presentUserIds"]), ("absentUserIds", rollup["absentUserIds"]))
+        }
+        stale = {field: firestore.ArrayRemove(ids) for field, ids in stale.items() if ids}
+        if stale:
+            batch.set(ref, stale, merge=True)
+
+        scheduled = {shift_id: firestore.DELETE_FIELD for shift_id in (current.get("scheduledShifts") or {}) if shift_id not in rollup["scheduledShifts"]}
+        scheduled.update(rollup["scheduledShifts"])
+        changes = {
+            "agencyId": agency_id,
+            "date": day,
+            "absentCount": firestore.Increment(len(absent) - (current.get("absentCount") or 0)),
+            "lateCount": firestore.Increment(rollup["lateCount"] - (current.get("lateCount") or 0)),
+            "overtimeHours": firestore.Increment(rollup["overtimeHours"] - (current.get("overtimeHours") or 0)),
+            "updatedAt": now,
+            "rebuiltAt": now
+        }
+        # ArrayUnion rejects an empty list
+        if present:
+            changes["presentUserIds"] = firestore.ArrayUnion(present)
+        if absent:
+            changes["absentUserIds"] = firestore.ArrayUnion(absent)
+        if scheduled:
+            changes["scheduledShifts"] = scheduled
+        batch.set(ref, changes, merge=True)
+        days[day] = {
+            **rollup,
+            "presentUserIds": present,
+            "absentUserIds": absent,
+            "absentCount": len(absent),
+            "updatedAt": now,
+            "rebuiltAt": now
         }
 
-        db.collection("attendance").add(absent_record)
-        marked.append(absent_record)
+        pending += 2
+        if pending >= 498:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+
+    logger.info(f"Rebuilt {len(days)} attendance rollups for agency {agency_id}")
+    return days
+
+
+@app.post("/dev/rollups/attendance/rebuild")
+def run_attendance_rollup_rebuild(
+    agency_id: str = Query(...),
+    start_date: str = Query(..., description="Date in YYYY-MM-DD format"),
+    end_date: str = Query(..., description="Date in YYYY-MM-DD format")
+):
+    """Backfill and drift repair; meant for an external scheduler, once per deployment."""
+    start = parse_sweep_date(start_date)
+    end = parse_sweep_date(end_date)
+    rebuilt = rebuild_attendance_rollups(agency_id, start, end)
+    return {"success": True, "rebuilt": len(rebuilt)}
+
+
+def fetch_attended_shift_ids(shift_ids: List[str]) -> set:
+    # Projected "in" queries: only the shiftId field comes back, 30 shifts per query
+    attended = set()
+    for chunk in chunked(shift_ids, FIRESTORE_IN_LIMIT):
+        query = db.collection("attendance").where("shiftId", "in", chunk).select(["shiftId"])
+        for doc in query.stream():
+            attended.add(doc.to_dict().get("shiftId"))
+    return attended
+
+
+def sweep_absentees(agency_ids: List[str], target_date, now: Optional[datetime] = None) -> Dict[str, List[dict]]:
+    """
+    Marks absent every finished shift on target_date that has no attendance,
+    for each agency. Reads scale with that day's shifts; absent records are
+    written in WriteBatch commits of up to 500.
+    """
+    now = now or datetime.now(timezone.utc)
+    timestamp = now.isoformat().replace("+00:00", "Z")
+
+    batch = db.batch()
+    pending = 0
+    marked: Dict[str, List[dict]] = {}
+
+    # A repeated agency would see its own uncommitted absences as unattended
+    # and mark them twice
+    for agency_id in dict.fromkeys(agency_ids):
+        marked[agency_id] = []
+
+        finished = [
+            shift for shift in iter_shifts_by_date(target_date, target_date, agency_id=agency_id)
+            if shift["shiftEndEpoch"] <= now.timestamp()  # Shift is over
+        ]
+        attended = fetch_attended_shift_ids([s["id"] for s in finished])
+
+        for shift in finished:
+            if shift["id"] in attended:
+                continue  # Already present or marked
+
+            absent_record = {
+                "agencyId": shift["agencyId"],
+                "userId": shift["employeeId"],
+                "siteId": shift["siteId"],
+                "shiftId": shift["id"],
+                "status": "absent",
+                "clockIn": None,
+                "clockOut": None,
+                "hoursWorked": 0,
+                "overtimeHours": 0,
+                "createdAt": timestamp,
+                "updatedAt": timestamp
+            }
+            batch.set(db.collection("attendance").document(), absent_record)
+            marked[agency_id].append(absent_record)
+
+            pending += 1
+            if pending == 500:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+
+        if marked[agency_id]:
+            bump_attendance_rollup(
+                agency_id, target_date.isoformat(),
+                absent=[r["userId"] for r in marked[agency_id]],
+                batch=batch
+            )
+            pending += 1
+            if pending == 500:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+
+    if pending:
+        batch.commit()
+
+    logger.info(f"Absentee sweep for {target_date}: {sum(len(m) for m in marked.values())} marked across {len(agency_ids)} agencies")
+    return marked
+
+
+def parse_sweep_date(date: str):
+    try:
+        return datetime.fromisoformat(date).date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+
+
+@app.post("/v1/attendance/mark-absentees")
+def mark_absentees(
+    date: str = Query(..., description="Date in YYYY-MM-DD format"),
+    agency_id: str = Query(...)
+):
+    target_date = parse_sweep_date(date)
+    marked = sweep_absentees([agency_id], target_date)[agency_id]
 
     return {
         "success": True,
@@ -785,6 +1815,24 @@ def mark_absentees(
     }
 
 
+@app.post("/v1/attendance/sweep-absentees")
+def sweep_all_absentees(
+    date: str = Query(..., description="Date in YYYY-MM-DD format"),
+    agency_ids: Optional[List[str]] = Query(None, description="Defaults to every agency")
+):
+    target_date = parse_sweep_date(date)
+    if not agency_ids:
+        agency_ids = [doc.id for doc in db.collection("agencies").select([]).stream()]
+
+    marked = sweep_absentees(agency_ids, target_date)
+
+    return {
+        "success": True,
+        "message": f"{sum(len(m) for m in marked.values())} absentees marked for {date}",
+        "agencies": {agency_id: len(records) for agency_id, records in marked.items()}
+    }
+
+
 @app.post("/v1/attendance/start-break", response_model=Attendance)
 def start_break(attendanceId: str):
     now_str = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
@@ -804,7 +1852,7 @@ def start_break(attendanceId: str):
     updated = update_document("attendance", attendanceId, {
         "breakPeriods": break_periods,
         "updatedAt": now_str
-    })
+    }, current=attendance)
 
     return updated
 
@@ -828,7 +1876,7 @@ def end_break(attendanceId: str):
     updated = update_document("attendance", attendanceId, {
         "breakPeriods": break_periods,
         "updatedAt": now_str
-    })
+    }, current=attendance)
 
     return updated
 
@@ -838,44 +1886,65 @@ def get_site_attendance_summary(
     start_date: str = Query(...),
     end_date: str = Query(...)
 ):
+    def parse_utc(dt_str: str) -> Optional[datetime]:
+        if not dt_str:
+            return None
+        try:
+            return parse_shift_utc(dt_str)
+        except ValueError:
+            return None
+
     try:
         start = datetime.fromisoformat(start_date).date()
         end = datetime.fromisoformat(end_date).date()
 
         # 1. All active employees grouped by site
-        employees = get_documents_by_field("employees", "agencyId", agency_id)
-        site_employee_map = {}
-
-        for emp in employees:
+        employees = db.collection("employees") \
+            .where("agencyId", "==", agency_id) \
+            .select(["status", "assignedsiteID"]) \
+            .stream()
+        site_employee_map: Dict[str, set] = {}
+
+        for emp_doc in employees:
+            emp = emp_doc.to_dict()
             if emp.get("status") == "active" and emp.get("assignedsiteID"):
-                site_id = emp["assignedsiteID"]
-                site_employee_map.setdefault(site_id, []).append(emp["id"])
+                site_employee_map.setdefault(emp["assignedsiteID"], set()).add(emp_doc.id)
+
+        # 2. Attendance clocked in during the range, bucketed by (siteId, userId) in one pass
+        attendance = db.collection("attendance") \
+            .where("agencyId", "==", agency_id) \
+            .where("clockIn", ">=", start.isoformat()) \
+            .where("clockIn", "<", (end + timedelta(days=1)).isoformat()) \
+            .select(["userId", "siteId", "clockIn", "scheduledStart"]) \
+            .stream()
+        buckets: Dict[tuple, List[int]] = {}
+
+        for att_doc in attendance:
+            a = att_doc.to_dict()
+            clock_in = parse_utc(a.get("clockIn"))
+            if not clock_in or not (start <= clock_in.date() <= end):
+                continue
 
-        # 2. All attendance records (not filtered yet)
-        attendance_records = get_documents_by_field("attendance", "agencyId", agency_id)
+            scheduled_start = parse_utc(a.get("scheduledStart"))
+            counts = buckets.setdefault((a.get("siteId"), a.get("userId")), [0, 0])
+            counts[0] += 1
+            if scheduled_start and clock_in > scheduled_start:
+                counts[1] += 1
 
         # 3. Get site names
-        sites = get_documents_by_field("sites", "agencyId", agency_id)
-        site_id_name_map = {s["id"]: s.get("name", "Unnamed Site") for s in sites if "id" in s}
+        sites = db.collection("sites").where("agencyId", "==", agency_id).select(["name"]).stream()
+        site_id_name_map = {s.id: s.to_dict().get("name", "Unnamed Site") for s in sites}
 
         # 4. Build summary
         site_summary = []
         for site_id, employee_ids in site_employee_map.items():
-            filtered_attendance = [
-                a for a in attendance_records
-                if a.get("userId") in employee_ids
-                and a.get("siteId") == site_id
-                and a.get("clockIn")
-                and start <= datetime.fromisoformat(a["clockIn"].replace("Z", "+00:00")).date() <= end
-            ]
-
-            present = len(filtered_attendance)
-            late = sum(
-                1 for a in filtered_attendance
-                if "scheduledStart" in a and
-                datetime.fromisoformat(a["clockIn"].replace("Z", "+00:00")) >
-                datetime.fromisoformat(a["scheduledStart"].replace("Z", "+00:00"))
-            )
+            present = 0
+            late = 0
+            for user_id in employee_ids:
+                counts = buckets.get((site_id, user_id))
+                if counts:
+                    present += counts[0]
+                    late += counts[1]
 
             total = len(employee_ids)
             absent = max(total - present, 0)
@@ -901,57 +1970,35 @@ def get_site_attendance_summary(
 
 
 @app.get("/v1/attendance/summary")
-def get_attendance_summary(agency_id: str = Query(...)):
-    from datetime import datetime, timedelta
-
+def get_attendance_summary(background_tasks: BackgroundTasks, agency_id: str = Query(...)):
     today = datetime.utcnow().date()
-    now = datetime.utcnow()
-
-    # 1. Fetch today's shifts for this agency
-    all_shifts = db.collection("shifts").where("agencyId", "==", agency_id).stream()
-    today_shifts = []
-    scheduled_employee_ids = set()
-
-    for shift_doc in all_shifts:
-        shift = shift_doc.to_dict()
-        shift_start = safe_parse_datetime(shift.get("shiftStart"))
-        if shift_start and shift_start.date() == today:
-            today_shifts.append((shift_doc.id, shift))
-            scheduled_employee_ids.add(shift["employeeId"])
-
-    # 2. Fetch all employees of the agency
-    all_employees = get_documents_by_field("employees", "agencyId", agency_id)
-    valid_employees = [
-    e for e in all_employees
-    if e.get("status") == "active"
-    and e.get("joinCodeStatus") == "used"
-    and e.get("assignedsiteID")
-    ]
-    all_employee_ids = set(e["id"] for e in valid_employees)
-
-
-    # 3. Fetch today’s attendance
-    attendance = db.collection("attendance").where("agencyId", "==", agency_id).stream()
-    present_ids = set()
-    late_count = 0
-    overtime_total = 0
-
-    for att_doc in attendance:
-        att = att_doc.to_dict()
-        clock_in = safe_parse_datetime(att.get("clockIn"))
-        if not clock_in or clock_in.date() != today:
-            continue
-
-        user_id = att["userId"]
-        present_ids.add(user_id)
-        overtime_total += att.get("overtimeHours", 0)
 
-        # Check if late
-        scheduled_start = safe_parse_datetime(att.get("scheduledStart"))
-        if scheduled_start and clock_in > scheduled_start:
-            late_count += 1
+    # 1. Today's rollup: present, late, overtime and scheduled employees.
+    # Incremental writes create partial documents, so only a rebuilt one is
+    # complete. Missing a rebuild, it is served as-is and one rebuild is
+    # queued after the response; rebuiltAt tells the client which it got.
+    rollup_doc = attendance_rollup_ref(agency_id, today.isoformat()).get()
+    rollup = rollup_doc.to_dict() if rollup_doc.exists else {}
+    if not rollup.get("rebuiltAt"):
+        queue_background_once(background_tasks, ("attendance-rollup", agency_id, today), rebuild_attendance_rollups, agency_id, today, today)
+
+    scheduled_employee_ids = {e for e in rollup.get("scheduledShifts", {}).values() if e}
+    present_ids = set(rollup.get("presentUserIds", []))
+    late_count = rollup.get("lateCount", 0)
+    overtime_total = rollup.get("overtimeHours", 0)
+
+    # 2. Employee roster, projected to the fields the eligibility check needs
+    roster = db.collection("employees") \
+        .where("agencyId", "==", agency_id) \
+        .select(["status", "joinCodeStatus", "assignedsiteID"]) \
+        .stream()
+    all_employee_ids = set()
+    for emp_doc in roster:
+        e = emp_doc.to_dict()
+        if e.get("status") == "active" and e.get("joinCodeStatus") == "used" and e.get("assignedsiteID"):
+            all_employee_ids.add(emp_doc.id)
 
-    # 4. Absentees
+    # 3. Absentees
     scheduled_absentees = scheduled_employee_ids - present_ids
     unscheduled_absentees = all_employee_ids - scheduled_employee_ids - present_ids
 
@@ -970,13 +2017,14 @@ def get_attendance_summary(agency_id: str = Query(...)):
         "overtime": {
             "totalHours": round(overtime_total, 2),
             "period": "this_week"
-        }
+        },
+        "rebuiltAt": rollup.get("rebuiltAt")
     }
 
 
 @app.get("/v1/attendance", response_model=List[Attendance])
-def read_attendance(agency_id: str = Query(...)):
-    return get_documents_by_field("attendance", "agencyId", agency_id)
+def read_attendance(response: Response, agency_id: str = Query(...), page: PageParams = Depends(PageParams)):
+    return page.respond(iter_documents_by_field("attendance", "agencyId", agency_id, page), response, Attendance, trusted=True)
 
 @app.post("/v1/attendance/clockin", response_model=Attendance)
 def clock_in(attendance: Attendance):
@@ -985,7 +2033,7 @@ def clock_in(attendance: Attendance):
     data = attendance.dict(exclude_unset=True)
     user_id = data["userId"]
     agency_id = data["agencyId"]
-    site_id = data["siteId"]
+    site_id = data.get("siteId")
     now = datetime.now(timezone.utc)
     now_str = now.isoformat().replace("+00:00", "Z")
 
@@ -993,16 +2041,24 @@ def clock_in(attendance: Attendance):
     if "lat" not in data or "lng" not in data:
         raise HTTPException(status_code=400, detail="Latitude and longitude are required for clock-in")
 
-    # ✅ Load geofence from site
-    site = get_document_by_id("sites", site_id)
-    coordinates = site.get("coordinates", [])
+    if site_id:
+        # ✅ Same agency index as the inferred path below, so both agree on the polygon
+        geofence = site_index_registry.get(agency_id).by_site.get(site_id)
 
-    if not coordinates or len(coordinates) < 3:
-        raise HTTPException(status_code=404, detail=f"No valid geofence coordinates defined for site {site_id}")
+        if geofence is None:
+            raise HTTPException(status_code=404, detail=f"No valid geofence coordinates defined for site {site_id}")
 
-    inside = is_inside_geofence(data["lat"], data["lng"], coordinates)
-    if not inside:
-        raise HTTPException(status_code=403, detail="You are outside the geofence for this site")
+        inside = geofence.contains(data["lat"], data["lng"])
+        if not inside:
+            raise HTTPException(status_code=403, detail="You are outside the geofence for this site")
+        candidate_sites = {site_id}
+    else:
+        # 📍 No siteId sent: infer it from the agency's spatial index
+        candidate_sites = {
+            fence.site["id"] for fence in site_index_registry.resolve(agency_id, data["lat"], data["lng"])
+        }
+        if not candidate_sites:
+            raise HTTPException(status_code=403, detail="You are not inside any site's geofence")
 
     # Prevent multiple clock-ins today
     today = now.date()   
@@ -1022,18 +2078,18 @@ def clock_in(attendance: Attendance):
     shift_id = None
     scheduled_start = None
 
-    potential_shifts = db.collection("shifts") \
-        .where("employeeId", "==", user_id) \
-        .where("siteId", "==", site_id) \
-        .where("agencyId", "==", agency_id).stream()
+    potential_shifts = iter_shifts_by_date(
+        today, today,
+        agency_id=agency_id, employee_id=user_id, site_id=site_id
+    )
 
     shifts_today = []
-    for shift_doc in potential_shifts:
-        shift = shift_doc.to_dict()
+    for shift in potential_shifts:
+        if shift["siteId"] not in candidate_sites:
+            continue
         shift_start = datetime.fromisoformat(shift["shiftStart"].replace("Z", "+00:00"))
         shift_end = datetime.fromisoformat(shift["shiftEnd"].replace("Z", "+00:00"))
-        if shift_start.date() == today:
-            shifts_today.append((shift_doc.id, shift, shift_start, shift_end))
+        shifts_today.append((shift["id"], shift, shift_start, shift_end))
 
     # Find the best shift for now
     best_shift = None
@@ -1051,6 +2107,7 @@ def clock_in(attendance: Attendance):
         raise HTTPException(status_code=403, detail="You do not have a scheduled shift to clock in for")
 
     shift_id = best_shift[0]
+    site_id = best_shift[1]["siteId"]
     scheduled_start = best_shift[2].isoformat() + "Z"
 
     # ✅ Build attendance record
@@ -1067,18 +2124,23 @@ def clock_in(attendance: Attendance):
         "updatedAt": now_str
     }
 
+    # Attendance record and today's rollup commit together
     saved_doc = db.collection("attendance").document()
-    saved_doc.set(record)
+    batch = db.batch()
+    batch.set(saved_doc, record)
+    bump_attendance_rollup(
+        agency_id, today.isoformat(),
+        present=user_id,
+        late=1 if now > best_shift[2] else 0,
+        batch=batch
+    )
+    bump_dashboard_metrics(agency_id, site_id, on_duty=1, on_duty_date=today.isoformat(), batch=batch)
+    batch.commit()
     record["attendanceId"] = saved_doc.id  # 🔁 inject the ID
     
-    # ✅ UPDATE EMPLOYEE LOCATION
-    db.collection("employees").document(user_id).update({
-     "lastKnownLocation": {
-         "lat": data["lat"],
-         "lng": data["lng"],
-         "updatedAt": now_str
-         }
-    })
+    # ✅ UPDATE EMPLOYEE LOCATION (coalesced, written on the next flush)
+    if not location_ingestor.submit(user_id, data["lat"], data["lng"], now_str):
+        logger.warning("Clock-in location dropped: location buffer full", extra={"userId": user_id})
     logger.info("Clock-in success", extra={"userId": user_id, "siteId": site_id, "shiftId": shift_id})
 
     return record
@@ -1092,15 +2154,10 @@ def update_employee_location(body: dict = Body(...)):
     lng = body["lng"]
     updated_at = body.get("updatedAt") or datetime.utcnow().isoformat() + "Z"
 
-    db.collection("employees").document(user_id).update({
-        "lastKnownLocation": {
-            "lat": lat,
-            "lng": lng,
-            "updatedAt": updated_at
-        }
-    })
+    if not location_ingestor.submit(user_id, lat, lng, updated_at):
+        raise HTTPException(status_code=429, detail="Location buffer full, retry shortly")
 
-    return {"success": True, "message": "Location updated"}
+    return {"success": True, "message": "Location queued"}
 
 #####
 
@@ -1165,7 +2222,7 @@ def clock_out(attendanceId: str):
             update_document("shifts", shift_id, {
                 "status": "completed",
                 "updatedAt": now_str
-            })
+            }, returning=False)
 
     # ✏️ Update attendance
     update_document("attendance", attendanceId, {
@@ -1173,7 +2230,18 @@ def clock_out(attendanceId: str):
         "hoursWorked": hours_worked,
         "overtimeHours": overtime_hours,
         "updatedAt": now_str
-    })
+    }, returning=False)
+
+    bump_dashboard_metrics(
+        attendance["agencyId"], attendance.get("siteId"), on_duty=-1,
+        on_duty_date=clock_in_time.astimezone(timezone.utc).date().isoformat()
+    )
+
+    if overtime_hours:
+        bump_attendance_rollup(
+            attendance["agencyId"], clock_in_time.astimezone(timezone.utc).date().isoformat(),
+            overtime=overtime_hours
+        )
 
     logger.info("Clock-out success", extra={
         "attendanceId": attendanceId,
@@ -1197,76 +2265,105 @@ def clock_out(attendanceId: str):
 #####################################################
 # 13. time sheets 
 #####################################################
-@app.get("/v1/timesheets")
-def get_timesheets(
-    agency_id: str = Query(...),
-    start_date: str = Query(...),
-    end_date: str = Query(...),
-    employee_id: str = Query(None),
-    site_id: str = Query(None)
-):
-    from datetime import datetime
 
-    def parse_utc(dt_str: str) -> datetime:
-        if dt_str.endswith("Z") and "+00:00" in dt_str:
-            dt_str = dt_str.replace("Z", "")
-        return datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
+def parse_timesheet_utc(dt_str: str) -> datetime:
+    if dt_str.endswith("Z") and "+00:00" in dt_str:
+        dt_str = dt_str.replace("Z", "")
+    return datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
+
+
+def fetch_attendance_by_shift_ids(shift_ids: List[str]) -> Dict[str, dict]:
+    # One "in" query per 30 shifts; the first record per shift wins, like the old .limit(1) lookup
+    by_shift = {}
+    for chunk in chunked(shift_ids, FIRESTORE_IN_LIMIT):
+        for doc in db.collection("attendance").where("shiftId", "in", chunk).stream():
+            data = doc.to_dict()
+            data["id"] = doc.id
+            by_shift.setdefault(data.get("shiftId"), data)
+    return by_shift
 
-    start = datetime.fromisoformat(start_date).date()
-    end = datetime.fromisoformat(end_date).date()
 
+def iter_timesheet_joins(
+    agency_id: str,
+    start,
+    end,
+    employee_id: Optional[str] = None,
+    site_id: Optional[str] = None
+):
+    """
+    Yields (shift, attendance, employee, site) for every shift in [start, end].
+    Employees and sites are loaded once, attendance is joined in chunks of
+    FIRESTORE_IN_LIMIT shifts, so reads stay constant per chunk of rows.
+    """
     employees = {e["id"]: e for e in get_documents_by_field("employees", "agencyId", agency_id)}
     sites = {s["id"]: s for s in get_documents_by_field("sites", "agencyId", agency_id)}
-    shifts = get_documents_by_field("shifts", "agencyId", agency_id)
 
-    timesheet = []
+    def join(pending: List[dict]):
+        attendance = fetch_attendance_by_shift_ids([s["id"] for s in pending])
+        for shift in pending:
+            yield (
+                shift,
+                attendance.get(shift["id"]),
+                employees.get(shift["employeeId"], {}),
+                sites.get(shift["siteId"], {})
+            )
 
-    for shift in shifts:
-        shift_start = parse_utc(shift["shiftStart"])
-        shift_end = parse_utc(shift["shiftEnd"])
-        shift_date = shift_start.date()
+    pending = []
+    for shift in iter_shifts_by_date(start, end, agency_id=agency_id, employee_id=employee_id, site_id=site_id):
+        pending.append(shift)
+        if len(pending) == FIRESTORE_IN_LIMIT:
+            yield from join(pending)
+            pending = []
+
+    if pending:
+        yield from join(pending)
+
+
+def build_timesheet_entry(shift: dict, record: Optional[dict], emp: dict, site: dict) -> dict:
+    entry = {
+        "shiftId": shift["id"],
+        "employeeId": shift["employeeId"],
+        "employeeName": emp.get("name", "Unknown"),
+        "siteName": site.get("name", "Unknown"),
+        "date": str(parse_timesheet_utc(shift["shiftStart"]).date()),
+        "shiftStart": shift["shiftStart"],
+        "shiftEnd": shift["shiftEnd"],
+        "clockIn": None,
+        "clockOut": None,
+        "hoursWorked": 0,
+        "overtimeHours": 0,
+        "status": "Absent"
+    }
 
-        if not (start <= shift_date <= end):
-            continue
-        if employee_id and shift["employeeId"] != employee_id:
-            continue
-        if site_id and shift["siteId"] != site_id:
-            continue
+    if record:
+        entry["clockIn"] = record.get("clockIn")
+        entry["clockOut"] = record.get("clockOut")
+        entry["hoursWorked"] = record.get("hoursWorked", 0)
+        entry["overtimeHours"] = record.get("overtimeHours", 0)
 
-        emp = employees.get(shift["employeeId"], {})
-        site = sites.get(shift["siteId"], {})
-
-        attendance = db.collection("attendance").where("shiftId", "==", shift["id"]).limit(1).stream()
-        record = next(attendance, None)
-
-        entry = {
-            "shiftId": shift["id"],
-            "employeeId": shift["employeeId"],
-            "employeeName": emp.get("name", "Unknown"),
-            "siteName": site.get("name", "Unknown"),
-            "date": str(shift_date),
-            "shiftStart": shift["shiftStart"],
-            "shiftEnd": shift["shiftEnd"],
-            "clockIn": None,
-            "clockOut": None,
-            "hoursWorked": 0,
-            "overtimeHours": 0,
-            "status": "Absent"
-        }
+        if entry["clockIn"]:
+            ci = parse_timesheet_utc(entry["clockIn"])
+            sched = parse_timesheet_utc(shift["shiftStart"])
+            entry["status"] = "Late" if ci > sched else "Present"
 
-        if record:
-            r = record.to_dict()
-            entry["clockIn"] = r.get("clockIn")
-            entry["clockOut"] = r.get("clockOut")
-            entry["hoursWorked"] = r.get("hoursWorked", 0)
-            entry["overtimeHours"] = r.get("overtimeHours", 0)
+    return entry
 
-            if entry["clockIn"]:
-                ci = parse_utc(entry["clockIn"])
-                sched = parse_utc(shift["shiftStart"])
-                entry["status"] = "Late" if ci > sched else "Present"
 
-        timesheet.append(entry)
+@app.get("/v1/timesheets")
+def get_timesheets(
+    agency_id: str = Query(...),
+    start_date: str = Query(...),
+    end_date: str = Query(...),
+    employee_id: str = Query(None),
+    site_id: str = Query(None)
+):
+    start = datetime.fromisoformat(start_date).date()
+    end = datetime.fromisoformat(end_date).date()
+
+    timesheet = [
+        build_timesheet_entry(shift, record, emp, site)
+        for shift, record, emp, site in iter_timesheet_joins(agency_id, start, end, employee_id, site_id)
+    ]
 
     return {
         "success": True,
@@ -1278,47 +2375,47 @@ def get_timesheets(
 
 
 
-@app.get("/v1/timesheets/export")
-def export_timesheets(
-    agency_id: str = Query(...),
-    start_date: str = Query(...),
-    end_date: str = Query(...),
-    employee_id: str = Query(None),
-    site_id: str = Query(None)
+TIMESHEET_EXPORT_FIELDS = [
+    "Employee Name", "Employee Code", "Site",
+    "Date", "Shift Start", "Shift End",
+    "Clock In", "Clock Out",
+    "Scheduled Hours", "Break Minutes",
+    "Hours Worked", "Overtime Hours", "Status", "Remarks"
+]
+
+# Rows buffered before a chunk is handed to the response
+TIMESHEET_EXPORT_FLUSH_ROWS = 200
+
+
+def iter_timesheet_csv(
+    agency_id: str,
+    start,
+    end,
+    employee_id: Optional[str] = None,
+    site_id: Optional[str] = None
 ):
     def parse_utc(dt_str: str) -> datetime:
         if not dt_str:
             return None
-        if dt_str.endswith("Z") and "+00:00" in dt_str:
-            dt_str = dt_str.replace("Z", "")
         try:
-            return datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
+            return parse_timesheet_utc(dt_str)
         except Exception:
             return None
 
     def format_datetime(dt: datetime) -> str:
         return dt.strftime("%d-%m-%Y %H:%M") if dt else ""
 
-    # Fetch timesheet data
-    data = get_timesheets(
-        agency_id=agency_id,
-        start_date=start_date,
-        end_date=end_date,
-        employee_id=employee_id,
-        site_id=site_id
-    )["data"]
-
     output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=[
-        "Employee Name", "Employee Code", "Site",
-        "Date", "Shift Start", "Shift End",
-        "Clock In", "Clock Out",
-        "Scheduled Hours", "Break Minutes",
-        "Hours Worked", "Overtime Hours", "Status", "Remarks"
-    ])
+    writer = csv.DictWriter(output, fieldnames=TIMESHEET_EXPORT_FIELDS)
     writer.writeheader()
+    yield output.getvalue()
+    output.seek(0)
+    output.truncate(0)
+
+    rows = 0
+    for shift, record, emp, site in iter_timesheet_joins(agency_id, start, end, employee_id, site_id):
+        row = build_timesheet_entry(shift, record, emp, site)
 
-    for row in data:
         scheduled_start = parse_utc(row.get("shiftStart"))
         scheduled_end = parse_utc(row.get("shiftEnd"))
         clock_in = parse_utc(row.get("clockIn"))
@@ -1326,25 +2423,17 @@ def export_timesheets(
 
         scheduled_hours = round((scheduled_end - scheduled_start).total_seconds() / 3600, 2) if scheduled_start and scheduled_end else 0
 
-        # Fetch break time
+        # Break time comes from the attendance record already joined to this shift
         break_minutes = 0
-        attendance = db.collection("attendance").where("shiftId", "==", row["shiftId"]).limit(1).stream()
-        record = next(attendance, None)
-        if record:
-            att = record.to_dict()
-            for b in att.get("breakPeriods", []):
-                bs = parse_utc(b.get("breakStart"))
-                be = parse_utc(b.get("breakEnd"))
-                if bs and be:
-                    break_minutes += (be - bs).total_seconds() / 60
-
-        # Load employeeCode
-        emp = get_document_by_id("employees", row.get("employeeId", "")) if row.get("employeeId") else {}
-        emp_code = emp.get("employeeCode", "")
+        for b in (record or {}).get("breakPeriods", []):
+            bs = parse_utc(b.get("breakStart"))
+            be = parse_utc(b.get("breakEnd"))
+            if bs and be:
+                break_minutes += (be - bs).total_seconds() / 60
 
         writer.writerow({
             "Employee Name": row.get("employeeName", ""),
-            "Employee Code": emp_code,
+            "Employee Code": emp.get("employeeCode", ""),
             "Site": row.get("siteName", ""),
             "Date": row.get("date", ""),
             "Shift Start": format_datetime(scheduled_start),
@@ -1359,10 +2448,49 @@ def export_timesheets(
             "Remarks": ""
         })
 
-    output.seek(0)
+        rows += 1
+        if rows % TIMESHEET_EXPORT_FLUSH_ROWS == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+
+    if output.tell():
+        yield output.getvalue()
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.get("/v1/timesheets/export")
+def export_timesheets(
+    agency_id: str = Query(...),
+    start_date: str = Query(...),
+    end_date: str = Query(...),
+    employee_id: str = Query(None),
+    site_id: str = Query(None),
+    gzip: bool = Query(False, description="Compress the CSV with gzip")
+):
+    start = datetime.fromisoformat(start_date).date()
+    end = datetime.fromisoformat(end_date).date()
+
+    rows = iter_timesheet_csv(agency_id, start, end, employee_id, site_id)
     filename = f"timesheet_{start_date}_to_{end_date}.csv"
+
+    if gzip:
+        return StreamingResponse(
+            gzip_chunks(rows),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f"attachment; filename={filename}.gz"}
+        )
+
     return StreamingResponse(
-        iter([output.getvalue()]),
+        rows,
         media_type="text/csv",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
@@ -1372,8 +2500,8 @@ def export_timesheets(
 #####################################################
 
 @app.get("/v1/messages", response_model=List[Message])
-def get_messages(agency_id: str = Query(...)):
-    return get_documents_by_field("messages", "agencyId", agency_id)
+def get_messages(response: Response, agency_id: str = Query(...), page: PageParams = Depends(PageParams)):
+    return page.respond(iter_documents_by_field("messages", "agencyId", agency_id, page), response, Message)
 
 @app.post("/v1/messages", response_model=Message)
 def create_message(message: Message):
@@ -1384,7 +2512,7 @@ def get_sender_id(authorization: str = Header(...)) -> str:
         raise HTTPException(status_code=401, detail="Invalid token format")
     token = authorization.split(" ")[1]
     try:
-        decoded = auth.verify_id_token(token)
+        decoded = verify_id_token_cached(token)
         logger.info(f"[Auth] Token decoded. UID: {decoded['uid']}")
         return decoded["uid"]
     except Exception as e:
@@ -1392,9 +2520,60 @@ def get_sender_id(authorization: str = Header(...)) -> str:
         raise HTTPException(status_code=403, detail="Invalid Firebase ID token")
 
 
+def resolve_broadcast_audience(site_id: str, audience: Optional[str]) -> List[str]:
+    """User IDs a site broadcast goes to, from one query."""
+    if audience == "all":
+        employees = db.collection("employees").where("assignedsiteID", "==", site_id).select([]).stream()
+        return [doc.id for doc in employees]
+
+    # "clocked-in": clock-ins at the site within the last shift window that
+    # are still open. clock_in never writes clockOut, so an equality filter
+    # on None would match nothing; records left open longer than a shift
+    # are stale, not on duty.
+    since = (datetime.now(timezone.utc) - MAX_SHIFT_DURATION).isoformat().replace("+00:00", "Z")
+    recent_attendance = db.collection("attendance") \
+        .where("siteId", "==", site_id) \
+        .where("clockIn", ">=", since) \
+        .select(["userId", "clockIn", "clockOut"]) \
+        .stream()
+    user_ids = []
+    for doc in recent_attendance:
+        data = doc.to_dict()
+        if data.get("userId") and not data.get("clockOut"):
+            user_ids.append(data["userId"])
+    return list(dict.fromkeys(user_ids))
+
+
+def fan_out_site_notification(notification_id: str, notification: dict, title: str) -> None:
+    """Writes an inbox entry per recipient in batches and hands delivery to the push dispatcher."""
+    recipients = resolve_broadcast_audience(notification["siteId"], notification.get("audience"))
+
+    entry = {**notification, "notificationId": notification_id, "read": False}
+    for chunk in chunked(recipients, 500):
+        batch = db.batch()
+        for user_id in chunk:
+            inbox_ref = db.collection("employees").document(user_id).collection("inbox").document(notification_id)
+            batch.set(inbox_ref, entry)
+        batch.commit()
+
+    if recipients:
+        push_dispatcher.enqueue(recipients, title, notification["text"], {
+            "notificationId": notification_id,
+            "siteId": notification["siteId"],
+            "type": "site-broadcast"
+        })
+
+    db.collection("sites").document(notification["siteId"]).collection("notifications").document(notification_id).update({
+        "recipientCount": len(recipients),
+        "fannedOutAt": datetime.utcnow().isoformat() + "Z"
+    })
+    logger.info(f"[Broadcast] Notification {notification_id} fanned out to {len(recipients)} recipients")
+
+
 @app.post("/v1/messages/broadcast", response_model=Dict[str, str])
 def broadcast_message(
     broadcast: BroadcastMessage,
+    background_tasks: BackgroundTasks,
     agency_id: str = Query(...)
 ):
     site = get_document_by_id("sites", broadcast.siteId)
@@ -1406,15 +2585,22 @@ def broadcast_message(
         agencyId=agency_id,
         senderId="admin",  # ✅ fallback value
         text=broadcast.text,
+        audience=broadcast.audience,
         createdAt=datetime.utcnow().isoformat() + "Z"
     )
 
     doc_ref = db.collection("sites").document(notification.siteId).collection("notifications").document()
     doc_ref.set(notification.dict())
 
+    # Audience resolution, inbox writes and push delivery run after the response is sent
+    background_tasks.add_task(
+        fan_out_site_notification, doc_ref.id, notification.dict(), site.get("name", "Site broadcast")
+    )
+
     return {
         "message": "Broadcast saved as site notification",
-        "notificationId": doc_ref.id
+        "notificationId": doc_ref.id,
+        "audience": notification.audience
     }
 
 
@@ -1449,15 +2635,14 @@ def get_broadcasts_for_agency(agency_id: str = Query(...)):
 #####################################################
 
 @app.get("/web/hourly-reports", response_model=List[HourlyReport])
-def get_hourly_reports(agency_id: str = Query(...)):
-    return get_documents_by_field("hourlyReports", "agencyId", agency_id)
+def get_hourly_reports(response: Response, agency_id: str = Query(...), page: PageParams = Depends(PageParams)):
+    return page.respond(iter_documents_by_field("hourlyReports", "agencyId", agency_id, page), response, HourlyReport, trusted=True)
 
 @app.post("/web/hourly-reports", response_model=HourlyReport)
 def create_hourly_report(report: HourlyReport):
     data = report.dict(exclude_unset=True)
-    saved = add_document("hourlyReports", data)
-    # Patch in the Firestore document ID as reportId
-    db.collection("hourlyReports").document(saved["id"]).update({"reportId": saved["id"]})
+    saved = add_document("hourlyReports", data, id_aliases=("reportId",))
+    bump_dashboard_metrics(saved["agencyId"], saved["siteId"], reports=1)
     return saved
 
 
@@ -1467,6 +2652,7 @@ def delete_hourly_report(report_id: str, agency_id: str = Query(...)):
     if report.get("agencyId") != agency_id:
         raise HTTPException(status_code=403, detail="Unauthorized")
     delete_document("hourlyReports", report_id)
+    bump_dashboard_metrics(agency_id, report.get("siteId"), reports=-1)
     return {"message": f"Hourly Report {report_id} deleted"}
 
 #####################################################
@@ -1477,23 +2663,79 @@ from datetime import datetime, timezone
 def parse_utc(dt_str: str) -> datetime:
     return datetime.fromisoformat(dt_str.replace("Z", "+00:00"))
 
+class ShiftIntervalIndex:
+    """
+    Sorted (start, end, shiftId) intervals for one employee, in epoch seconds.
+    Overlap checks bisect into the window that could reach the proposed
+    shift, and accepted proposals are inserted so a batch is checked
+    against itself as well as against what is already stored.
+    """
+
+    def __init__(self, intervals: List[tuple]):
+        self._intervals = sorted(intervals)
+        self._starts = [i[0] for i in self._intervals]
+
+    def find_overlap(self, start: int, end: int, exclude_shift_id: Optional[str] = None) -> Optional[str]:
+        lo = bisect.bisect_left(self._starts, start - int(MAX_SHIFT_DURATION.total_seconds()))
+        hi = bisect.bisect_left(self._starts, end)
+        for existing_start, existing_end, shift_id in self._intervals[lo:hi]:
+            if exclude_shift_id and shift_id == exclude_shift_id:
+                continue  # skip the shift being updated
+            if existing_start < end and start < existing_end:
+                return shift_id or "pending"
+        return None
+
+    def add(self, start: int, end: int, shift_id: Optional[str] = None) -> None:
+        pos = bisect.bisect_left(self._starts, start)
+        self._starts.insert(pos, start)
+        self._intervals.insert(pos, (start, end, shift_id))
+
+
+def load_shift_interval_index(employee_id: str, window_start: int, window_end: int) -> ShiftIntervalIndex:
+    # Only shifts starting inside the window (minus the longest shift) can overlap it
+    query = shift_query(employee_id=employee_id) \
+        .where("shiftStartEpoch", ">=", window_start - int(MAX_SHIFT_DURATION.total_seconds())) \
+        .where("shiftStartEpoch", "<", window_end)
+    intervals = []
+    for doc in query.stream():
+        data = doc.to_dict()
+        intervals.append((data["shiftStartEpoch"], data["shiftEndEpoch"], doc.id))
+    return ShiftIntervalIndex(intervals)
+
+
 def check_shift_conflict(employee_id: str, new_start: str, new_end: str, exclude_shift_id: Optional[str] = None) -> bool:
-    new_start_dt = parse_utc(new_start)
-    new_end_dt = parse_utc(new_end)
+    fields = checked_shift_index_fields(new_start, new_end)
+    start, end = fields["shiftStartEpoch"], fields["shiftEndEpoch"]
+    index = load_shift_interval_index(employee_id, start, end)
+    return index.find_overlap(start, end, exclude_shift_id) is not None
+
+
+def find_shift_conflicts(proposals: List[dict]) -> List[Optional[str]]:
+    """
+    Checks many proposed shifts ({employeeId, shiftStart, shiftEnd, optional
+    shiftId}) with one range query per employee. Returns, per proposal, the
+    ID of the shift it collides with ("pending" for another proposal) or None.
+    """
+    by_employee: Dict[str, List[tuple]] = {}
+    for pos, proposal in enumerate(proposals):
+        fields = checked_shift_index_fields(proposal["shiftStart"], proposal["shiftEnd"])
+        by_employee.setdefault(proposal["employeeId"], []).append(
+            (fields["shiftStartEpoch"], fields["shiftEndEpoch"], pos)
+        )
 
-    shifts = db.collection("shifts").where("employeeId", "==", employee_id).stream()
-    for shift in shifts:
-        data = shift.to_dict()
-        if exclude_shift_id and shift.id == exclude_shift_id:
-            continue  # skip the shift being updated
+    conflicts: List[Optional[str]] = [None] * len(proposals)
+    for employee_id, wanted in by_employee.items():
+        window_start = min(w[0] for w in wanted)
+        window_end = max(w[1] for w in wanted)
+        index = load_shift_interval_index(employee_id, window_start, window_end)
 
-        existing_start = parse_utc(data["shiftStart"])
-        existing_end = parse_utc(data["shiftEnd"])
+        for start, end, pos in sorted(wanted):
+            shift_id = proposals[pos].get("shiftId")
+            conflicts[pos] = index.find_overlap(start, end, exclude_shift_id=shift_id)
+            if conflicts[pos] is None:
+                index.add(start, end, shift_id)
 
-        # Check overlap
-        if (existing_start < new_end_dt) and (new_start_dt < existing_end):
-            return True
-    return False
+    return conflicts
 
 
 @app.get("/v1/calendar/shifts")
@@ -1501,27 +2743,20 @@ def get_calendar_shifts(
     agency_id: str = Query(...),
     start_date: str = Query(...),
     end_date: str = Query(...),
-    site_id: Optional[str] = Query(None)
+    site_id: Optional[str] = Query(None),
+    loader: DocumentLoader = Depends(DocumentLoader)
 ):
-    shifts = get_documents_by_field("shifts", "agencyId", agency_id)
-
     start = datetime.fromisoformat(start_date.rstrip("Z"))
     end = datetime.fromisoformat(end_date.rstrip("Z"))
 
-    filtered_shifts = []
-    for shift in shifts:
-        shift_start = datetime.fromisoformat(shift["shiftStart"].rstrip("Z"))
-        shift_end = datetime.fromisoformat(shift["shiftEnd"].rstrip("Z"))
-
-        # 🧠 Date range overlap check
-        if (shift_end < start or shift_start > end):
-            continue
+    # 🧠 Date range overlap and ❗ site filter are applied by the shift index query
+    filtered_shifts = list(iter_shifts_in_window(start, end, agency_id=agency_id, site_id=site_id))
 
-        # ❗ Site filter
-        if site_id and shift.get("siteId") != site_id:
-            continue
-
-        filtered_shifts.append(shift)
+    # Load every distinct employee and site in one batched pass
+    loader.prime_all({
+        "employees": [s["employeeId"] for s in filtered_shifts],
+        "sites": [s["siteId"] for s in filtered_shifts]
+    })
 
     # Format as FullCalendar events
     calendar_events = []
@@ -1529,8 +2764,8 @@ def get_calendar_shifts(
         employee_id = shift["employeeId"]
         site_id = shift["siteId"]
 
-        employee = get_document_by_id("employees", employee_id)
-        site = get_document_by_id("sites", site_id)
+        employee = loader.load("employees", employee_id)
+        site = loader.load("sites", site_id)
 
         calendar_events.append({
             "id": shift["id"],
@@ -1555,7 +2790,8 @@ def create_calendar_shift(
     site_id: str = Body(...),
     start: str = Body(...),
     end: str = Body(...),
-    agency_id: str = Body(...)
+    agency_id: str = Body(...),
+    loader: DocumentLoader = Depends(DocumentLoader)
 ):
     """Create a shift from calendar UI"""
 
@@ -1574,10 +2810,12 @@ def create_calendar_shift(
         shiftEnd=end
     )
     
-    result = add_document("shifts", shift.dict(exclude_unset=True))
+    result = add_document("shifts", with_shift_index(shift.dict(exclude_unset=True)))
+    rollup_scheduled_shift(result)
     
-    employee = get_document_by_id("employees", employee_id)
-    site = get_document_by_id("sites", site_id)
+    loader.prime_all({"employees": [employee_id], "sites": [site_id]})
+    employee = loader.load("employees", employee_id)
+    site = loader.load("sites", site_id)
     
     return {
         "id": result["id"],
@@ -1600,7 +2838,8 @@ def update_calendar_shift(
     end: str = Body(...),
     employee_id: Optional[str] = Body(None),
     site_id: Optional[str] = Body(None),
-    agency_id: str = Query(...)
+    agency_id: str = Query(...),
+    loader: DocumentLoader = Depends(DocumentLoader)
 ):
     """Update shift times or assignment from calendar dragging/resizing"""
     shift = get_document_by_id("shifts", shift_id)
@@ -1616,19 +2855,22 @@ def update_calendar_shift(
             detail="Shift conflict: Employee already has a shift during this time."
         )
 
-    update_data = {
+    update_data = with_shift_index({
         "shiftStart": start,
         "shiftEnd": end,
-    }
+    })
     if employee_id:
         update_data["employeeId"] = employee_id
     if site_id:
         update_data["siteId"] = site_id
 
-    result = update_document("shifts", shift_id, update_data)
+    previous = dict(shift)
+    result = update_document("shifts", shift_id, update_data, current=shift)
+    rollup_scheduled_shift(result, shift_id=shift_id, previous=previous)
 
-    employee = get_document_by_id("employees", result["employeeId"])
-    site = get_document_by_id("sites", result["siteId"])
+    loader.prime_all({"employees": [result["employeeId"]], "sites": [result["siteId"]]})
+    employee = loader.load("employees", result["employeeId"])
+    site = loader.load("sites", result["siteId"])
 
     return {
         "id": shift_id,
@@ -1643,6 +2885,51 @@ def update_calendar_shift(
         }
     }
 
+@app.post("/v1/calendar/shifts/bulk")
+def bulk_create_calendar_shifts(shifts: List[Shift] = Body(...)):
+    """Create many shifts at once; conflicts are checked in one pass per employee"""
+    proposals = [with_shift_index(s.dict(exclude_unset=True)) for s in shifts]
+    conflicts = find_shift_conflicts(proposals)
+
+    now = datetime.utcnow().isoformat() + "Z"
+    batch = db.batch()
+    pending = 0
+    created = []
+    rejected = []
+
+    for data, conflict in zip(proposals, conflicts):
+        if conflict:
+            rejected.append({
+                "employeeId": data["employeeId"],
+                "shiftStart": data["shiftStart"],
+                "shiftEnd": data["shiftEnd"],
+                "conflictsWith": conflict
+            })
+            continue
+
+        doc_ref = db.collection("shifts").document()
+        data["id"] = doc_ref.id
+        data["createdAt"] = now
+        data["updatedAt"] = now
+        batch.set(doc_ref, data)
+        rollup_scheduled_shift(data, batch=batch)
+        created.append(data)
+
+        pending += 2  # shift + rollup
+        if pending >= 499:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+
+    return {
+        "success": True,
+        "created": created,
+        "conflicts": rejected
+    }
+
 #####################################################
 # 16. employee endpoints
 #####################################################
@@ -1659,41 +2946,42 @@ def add_employee(employee: EmployeeModel):
     data["joinCode"] = generate_unique_employee_join_code()
     data["joinCodeStatus"] = "unused"
 
-    return add_document("employees", data)
-
-
-
-
-def get_documents_by_field(collection: str, field: str, value: str) -> List[dict]:
-    logger.info(f"Querying {collection} where {field} = {value}")
-    docs = db.collection(collection).stream() if field == "all" else db.collection(collection).where(field, "==", value).stream()
-    result = []
-    for doc in docs:
-        data = doc.to_dict()
-        data["id"] = doc.id  # 🔥 Include Firestore document ID
-        result.append(data)
-    logger.info(f"Found {len(result)} documents in {collection}")
+    result = add_document("employees", data)
+    bump_dashboard_metrics(result["agencyId"], result.get("assignedsiteID"), employees=1)
     return result
 
 
 
+
 @app.get("/v1/employees/{employee_id}")
 def get_employee_by_id(employee_id: str):
     return get_document_by_id("employees", employee_id)
 
 @app.patch("/v1/employees/{employee_id}")
 def update_employee_by_id(employee_id: str, employee: EmployeeModel):
-    return update_document("employees", employee_id, employee.dict(exclude_unset=True))
+    existing = get_document_by_id("employees", employee_id)
+    result = update_document("employees", employee_id, employee.dict(exclude_unset=True), current=existing)
+    if existing.get("uid") and existing.get("uid") != result.get("uid"):
+        invalidate_user_auth_cache(existing["uid"])
+    old_site, new_site = existing.get("assignedsiteID"), result.get("assignedsiteID")
+    if old_site != new_site:
+        bump_dashboard_metrics(existing.get("agencyId"), old_site, employees=-1)
+        bump_dashboard_metrics(result.get("agencyId"), new_site, employees=1)
+    return result
 
 @app.delete("/v1/employees/{employee_id}")
 def delete_employee_by_id(employee_id: str):
+    existing = get_document_by_id("employees", employee_id)
     delete_document("employees", employee_id)
+    if existing.get("uid"):
+        invalidate_user_auth_cache(existing["uid"])
+    bump_dashboard_metrics(existing.get("agencyId"), existing.get("assignedsiteID"), employees=-1)
     return {"message": "Deleted"}
 
 
 @app.get("/web/employee/all")
-def get_all_employees(agency_id: str = Query(...)):
-    return get_documents_by_field("employees", "agencyId", agency_id)
+def get_all_employees(response: Response, agency_id: str = Query(...), page: PageParams = Depends(PageParams)):
+    return page.respond(iter_documents_by_field("employees", "agencyId", agency_id, page), response)
 
 @app.post("/v1/employees/bulk-import")
 def bulk_import_employees(employees: List[EmployeeModel] = Body(...)):
@@ -1701,6 +2989,7 @@ def bulk_import_employees(employees: List[EmployeeModel] = Body(...)):
     now = datetime.utcnow().isoformat()
     imported = 0
     failed = []
+    assigned = {}
 
     for emp in employees:
         try:
@@ -1717,9 +3006,15 @@ def bulk_import_employees(employees: List[EmployeeModel] = Body(...)):
             doc_ref = db.collection("employees").document()
             batch.set(doc_ref, data)
             imported += 1
+            site_key = (data.get("agencyId"), data.get("assignedsiteID"))
+            assigned[site_key] = assigned.get(site_key, 0) + 1
         except Exception as e:
             failed.append({"employee": emp.name, "error": str(e)})
 
+    # Dashboard employee counts commit with the employees themselves
+    for (agency_id, site_id), count in assigned.items():
+        bump_dashboard_metrics(agency_id, site_id, employees=count, batch=batch)
+
     try:
         batch.commit()
     except Exception as e:
@@ -1746,6 +3041,7 @@ def bulk_import_employees(employees: List[EmployeeModel] = Body(...)):
 def submit_hourly_report(report: HourlyReport):
     data = report.dict(exclude_unset=True)
     saved = add_document("hourlyReports", data)
+    bump_dashboard_metrics(saved["agencyId"], saved["siteId"], reports=1)
 
     # Explicitly include the document ID as reportId
     saved["reportId"] = saved["id"]
@@ -1762,9 +3058,64 @@ def verify_geofence(site_id: str = Query(...), lat: float = Query(...), lng: flo
     geofences = get_documents_by_field("geofences", "siteId", site_id)
     if not geofences:
         raise HTTPException(status_code=404, detail="No geofence found for this site")
-    inside = any(is_inside_geofence(lat, lng, g["coordinates"]) for g in geofences)
+    inside = any(
+        geofence_cache.get(f"geofences/{g['id']}", g.get("updatedAt"), g["coordinates"]).contains(lat, lng)
+        for g in geofences
+    )
     return {"insideGeofence": inside}
 
+@app.get("/mobile/geofence/resolve-site")
+def resolve_site(agency_id: str = Query(...), lat: float = Query(...), lng: float = Query(...)):
+    """Which of the agency's sites contain this point, from the in-process spatial index"""
+    matches = site_index_registry.resolve(agency_id, lat, lng)
+    return {
+        "count": len(matches),
+        "sites": [
+            {"siteId": fence.site["id"], "name": fence.site.get("name")}
+            for fence in matches
+        ]
+    }
+
+@app.post("/mobile/geofence/verify-batch")
+def verify_geofence_batch(payload: GeofenceBatchRequest):
+    """Checks many positions at once, grouped per site and evaluated with vectorized predicates"""
+    by_site: Dict[str, List[int]] = {}
+    for pos, point in enumerate(payload.points):
+        site_id = point.siteId or payload.siteId
+        if not site_id:
+            raise HTTPException(status_code=400, detail=f"Point {point.id or pos} has no siteId")
+        by_site.setdefault(site_id, []).append(pos)
+
+    results = [None] * len(payload.points)
+    for site_id, positions in by_site.items():
+        # Same source as /mobile/geofence/verify: the site's geofences documents,
+        # a point being inside if any of them contains it
+        geofences = get_documents_by_field("geofences", "siteId", site_id)
+        if not geofences:
+            for pos in positions:
+                results[pos] = {"siteId": site_id, "insideGeofence": None, "error": "No geofence found for this site"}
+            continue
+
+        lats = np.fromiter((payload.points[p].lat for p in positions), dtype=float, count=len(positions))
+        lngs = np.fromiter((payload.points[p].lng for p in positions), dtype=float, count=len(positions))
+        inside = np.zeros(len(positions), dtype=bool)
+        for g in geofences:
+            fence = geofence_cache.get(f"geofences/{g['id']}", g.get("updatedAt"), g["coordinates"])
+            inside |= fence.contains_many(lats, lngs)
+
+        for pos, flag in zip(positions, inside.tolist()):
+            results[pos] = {"siteId": site_id, "insideGeofence": flag}
+
+    for point, result in zip(payload.points, results):
+        result.update({"id": point.id, "lat": point.lat, "lng": point.lng})
+
+    return {
+        "success": True,
+        "count": len(results),
+        "inside": sum(1 for r in results if r["insideGeofence"]),
+        "results": results
+    }
+
 @app.get("/mobile/shifts/assigned", response_model=List[Shift])
 def get_assigned_shifts(employee_id: str = Query(...)):
     shifts = get_documents_by_field("shifts", "employeeId", employee_id)
@@ -1786,7 +3137,7 @@ def update_shift_status(
     shift = get_document_by_id("shifts", shift_id)
     if shift.get("employeeId") != employee_id:
         raise HTTPException(status_code=403, detail="You are not assigned to this shift")
-    return update_document("shifts", shift_id, {"status": status.value})
+    return update_document("shifts", shift_id, {"status": status.value}, current=shift)
 
 
 @app.get("/mobile/shifts/open", response_model=List[Shift])
@@ -1810,25 +3161,26 @@ def apply_for_shift(shift_id: str, employee_id: str = Query(...)):
             detail="Shift conflict: You already have a shift during this time."
         )
 
-    return update_document("shifts", shift_id, {
+    result = update_document("shifts", shift_id, {
         "employeeId": employee_id,
         "status": "pending"
-    })
+    }, current=shift)
+    rollup_scheduled_shift(result, shift_id=shift_id)
+    return result
 
 
 
 @app.post("/mobile/employee/login")
 def mobile_login(payload: LoginRequest):
     try:
-        decoded = auth.verify_id_token(payload.idToken)
+        decoded = verify_id_token_cached(payload.idToken)
         uid = decoded["uid"]
 
         # Lookup employee by UID
-        employees = get_documents_by_field("employees", "uid", uid)
-        if not employees:
+        employee = resolve_user_employee(uid)
+        if not employee:
             raise HTTPException(status_code=404, detail="Employee not found")
 
-        employee = employees[0]
         return {
             "message": "Employee login successful",
             "uid": uid,
@@ -1850,7 +3202,7 @@ class EmployeeRegisterPayload(BaseModel):
 
 @app.post("/mobile/employee/register")
 def register_with_join_code(payload: EmployeeJoinCodeRegisterPayload):
-    decoded = auth.verify_id_token(payload.idToken)
+    decoded = verify_id_token_cached(payload.idToken)
     uid = decoded["uid"]
     email = decoded.get("email")
 
@@ -1890,6 +3242,7 @@ def register_with_join_code(payload: EmployeeJoinCodeRegisterPayload):
 
     db.collection("employees").document(emp_id).update(updated_data)
     emp_data.update(updated_data)
+    invalidate_user_auth_cache(uid)
 
     return {
         "message": "Employee successfully registered",
@@ -1911,7 +3264,7 @@ def regenerate_join_code(employee_id: str):
     update_document("employees", employee_id, {
         "joinCode": new_code,
         "updatedAt": datetime.utcnow().isoformat() + "Z"
-    })
+    }, returning=False)
     return {"success": True, "joinCode": new_code}
 
 
@@ -1919,8 +3272,182 @@ def regenerate_join_code(employee_id: str):
 
 ## push notficiation module 
 
-#send push helper 
+class PushDispatcher:
+    """
+    Background push pipeline. send_push only enqueues; a worker drains the
+    queue in batches, loads device tokens for every recipient with one
+    get_all, merges recipients of identical messages, chunks tokens to
+    FCM's 500-per-call limit and sends the chunks concurrently. Tokens FCM
+    reports as unregistered are pruned from devices/{uid}.
+    """
+    FCM_MAX_TOKENS = 500
+
+    def __init__(self, max_queue: int = 10000, batch_size: int = 200, batch_wait: float = 0.2, concurrency: int = 8, drain_timeout: float = 10):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.drain_timeout = drain_timeout
+        self._drain_deadline = float("inf")
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="push-send")
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.metrics = {"queued": 0, "dropped": 0, "batches": 0, "calls": 0, "sent": 0, "failed": 0, "pruned": 0, "noDevices": 0}
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self.metrics[key] += n
+
+    def enqueue(self, uids: List[str], title: str, body: str, data: Optional[dict] = None) -> bool:
+        try:
+            self._queue.put_nowait((list(uids), title, body, dict(data or {})))
+        except queue.Full:
+            self._count("dropped")
+            logger.warning(f"[Push] Queue full, dropped notification for {len(uids)} recipients")
+            return False
+        self._count("queued")
+        return True
+
+    def _drain(self) -> list:
+        try:
+            jobs = [self._queue.get(timeout=1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_wait
+        while len(jobs) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                jobs.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return jobs
+
+    def _load_tokens(self, uids: List[str]) -> Dict[str, List[str]]:
+        tokens = {}
+        refs = [db.collection("devices").document(uid) for uid in uids]
+        for chunk in chunked(refs, 100):
+            for snap in db.get_all(chunk):
+                if snap.exists:
+                    tokens[snap.id] = snap.to_dict().get("tokens", [])
+        return tokens
+
+    def _send_chunk(self, tokens: List[str], title: str, body: str, data: dict) -> List[str]:
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(title=title, body=body),
+            data=data,
+            tokens=tokens
+        )
+        send = getattr(messaging, "send_each_for_multicast", None) or messaging.send_multicast
+        response = send(message)
+        self._count("calls")
+        self._count("sent", response.success_count)
+        self._count("failed", response.failure_count)
+
+        dead = []
+        for token, resp in zip(tokens, response.responses):
+            if not resp.success and isinstance(resp.exception, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+                dead.append(token)
+        return dead
+
+    def _prune(self, dead_by_uid: Dict[str, List[str]]) -> None:
+        updates = [(uid, tokens) for uid, tokens in dead_by_uid.items() if tokens]
+        for chunk in chunked(updates, 500):
+            batch = db.batch()
+            for uid, tokens in chunk:
+                batch.update(db.collection("devices").document(uid), {"tokens": firestore.ArrayRemove(tokens)})
+            batch.commit()
+        pruned = sum(len(t) for _, t in updates)
+        if pruned:
+            self._count("pruned", pruned)
+            logger.info(f"[Push] Pruned {pruned} unregistered tokens")
+
+    def process(self, jobs: list) -> None:
+        tokens_by_uid = self._load_tokens(list(dict.fromkeys(uid for job in jobs for uid in job[0])))
+
+        # Recipients of identical messages share token chunks
+        grouped: Dict[tuple, Dict[str, str]] = {}
+        for uids, title, body, data in jobs:
+            owners = grouped.setdefault((title, body, tuple(sorted(data.items()))), {})
+            for uid in uids:
+                user_tokens = tokens_by_uid.get(uid)
+                if not user_tokens:
+                    self._count("noDevices")
+                    continue
+                for token in user_tokens:
+                    owners[token] = uid
+
+        futures = {}
+        for (title, body, data_items), owners in grouped.items():
+            for chunk in chunked(list(owners), self.FCM_MAX_TOKENS):
+                future = self._executor.submit(self._send_chunk, chunk, title, body, dict(data_items))
+                futures[future] = (owners, chunk)
+
+        dead_by_uid: Dict[str, List[str]] = {}
+        for future in as_completed(futures):
+            owners, chunk = futures[future]
+            try:
+                for token in future.result():
+                    dead_by_uid.setdefault(owners[token], []).append(token)
+            except Exception as e:
+                # The whole call failed, so none of the chunk's tokens got the message
+                self._count("failed", len(chunk))
+                logger.error(f"[Push] Multicast send to {len(chunk)} tokens failed: {e}")
+
+        self._prune(dead_by_uid)
+        self._count("batches")
+
+    def _run(self) -> None:
+        # After stop() the queue is still drained, until it is empty or the deadline passes
+        while not self._stop.is_set() or not self._queue.empty():
+            if time.monotonic() > self._drain_deadline:
+                break
+            jobs = self._drain()
+            if not jobs:
+                continue
+            try:
+                self.process(jobs)
+            except Exception as e:
+                logger.error(f"[Push] Batch of {len(jobs)} notifications failed: {e}")
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._drain_deadline = float("inf")
+            self._thread = threading.Thread(target=self._run, name="push-dispatch", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """Sends what is still queued, for at most drain_timeout seconds, then shuts down."""
+        self._drain_deadline = time.monotonic() + self.drain_timeout
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.drain_timeout + 5)
+        self._executor.shutdown(wait=True)
+
+        unsent = self._queue.qsize()
+        if unsent:
+            self._count("dropped", unsent)
+            logger.warning(f"[Push] Shut down with {unsent} notifications still queued")
+
+
+push_dispatcher = PushDispatcher()
+
+
+@app.on_event("startup")
+def start_push_dispatcher():
+    push_dispatcher.start()
+
+
+@app.on_event("shutdown")
+def stop_push_dispatcher():
+    push_dispatcher.stop()
+
 
+@app.get("/dev/push/metrics")
+def push_metrics():
+    return {"queueDepth": push_dispatcher._queue.qsize(), **push_dispatcher.metrics}
 
 
 #register your mobile device 
@@ -1940,14 +3467,19 @@ def get_reports_for_employee(employee_id: str = Query(...), agency_id: str = Que
     return [r.to_dict() for r in reports]
 
 @app.get("/mobile/hourly-reports/{report_id}")
-def get_single_hourly_report(report_id: str, agency_id: str = Query(...)):
+def get_single_hourly_report(
+    report_id: str,
+    agency_id: str = Query(...),
+    loader: DocumentLoader = Depends(DocumentLoader)
+):
     report = get_document_by_id("hourlyReports", report_id)
 
     if report["agencyId"] != agency_id:
         raise HTTPException(status_code=403, detail="Unauthorized access to report")
 
-    site = get_document_by_id("sites", report["siteId"])
-    employee = get_document_by_id("employees", report["userId"])
+    loader.prime_all({"sites": [report["siteId"]], "employees": [report["userId"]]})
+    site = loader.load("sites", report["siteId"])
+    employee = loader.load("employees", report["userId"])
 
     # Format datetime
     dt = safe_parse_datetime(report.get("createdAt"))
@@ -1969,6 +3501,241 @@ def get_single_hourly_report(report_id: str, agency_id: str = Query(...)):
 
 
 
+##########################################
+#location ingestion
+##########################################
+class LocationIngestor:
+    """
+    Buffers location pings in memory and coalesces them to the latest fix
+    per employee. A timer thread flushes with batched writes, so Firestore
+    sees at most one lastKnownLocation write per employee per interval no
+    matter how often guards ping. New employees are refused once
+    max_pending is reached, which is the caller's backpressure signal.
+    Pings for IDs with no employee document are dropped at flush time;
+    writes that fail are put back in the buffer for the next flush.
+    """
+
+    def __init__(
+        self,
+        flush_interval: float = 30,
+        max_pending: int = 10000,
+        max_track_points: int = 50000,
+        keep_tracks: bool = True
+    ):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_track_points = max_track_points
+        self.keep_tracks = keep_tracks
+        self._latest: Dict[str, dict] = {}
+        self._tracks: Dict[tuple, List[dict]] = {}
+        self._track_points = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {
+            "accepted": 0, "coalesced": 0, "rejected": 0, "flushes": 0, "writes": 0, "failures": 0, "unknown": 0,
+            "requeued": 0, "trackPointsDropped": 0
+        }
+        self._track_points_dropped = 0  # since the last flush, for its log line
+
+    def submit(self, user_id: str, lat: float, lng: float, recorded_at: str) -> bool:
+        fix = {"lat": lat, "lng": lng, "updatedAt": recorded_at}
+        with self._lock:
+            current = self._latest.get(user_id)
+            if current is None and len(self._latest) >= self.max_pending:
+                self.stats["rejected"] += 1
+                return False
+
+            if current is None or current["updatedAt"] <= recorded_at:
+                self._latest[user_id] = fix
+            if current is not None:
+                self.stats["coalesced"] += 1
+            self.stats["accepted"] += 1
+
+            # Compact history, bucketed per employee per hour
+            if self.keep_tracks:
+                bucket = recorded_at[:13].replace("-", "").replace("T", "")  # YYYYMMDDHH
+                self._add_track_points(user_id, bucket, [{"lat": lat, "lng": lng, "t": recorded_at}])
+        return True
+
+    def _add_track_points(self, user_id: str, bucket: str, points: List[dict]) -> None:
+        """Buffers track points up to max_track_points; the rest are counted as dropped. Call with the lock held."""
+        room = max(self.max_track_points - self._track_points, 0)
+        if room:
+            self._tracks.setdefault((user_id, bucket), []).extend(points[:room])
+            self._track_points += min(room, len(points))
+        dropped = len(points) - room
+        if dropped > 0:
+            self.stats["trackPointsDropped"] += dropped
+            self._track_points_dropped += dropped
+
+    def _requeue(self, locations: List[tuple], tracks: Dict[tuple, List[dict]]) -> None:
+        """Puts back writes that failed, unless a newer fix arrived meanwhile."""
+        with self._lock:
+            for user_id, fix in locations:
+                current = self._latest.get(user_id)
+                if current is None or current["updatedAt"] < fix["updatedAt"]:
+                    self._latest[user_id] = fix
+            for (user_id, bucket), points in tracks.items():
+                self._add_track_points(user_id, bucket, points)
+            self.stats["requeued"] += len(locations)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._latest)
+
+    def flush(self) -> int:
+        with self._lock:
+            latest, self._latest = self._latest, {}
+            tracks, self._tracks = self._tracks, {}
+            self._track_points = 0
+            truncated, self._track_points_dropped = self._track_points_dropped, 0
+
+        if truncated:
+            logger.warning(f"[Location] Track buffer full (max_track_points={self.max_track_points}): dropped {truncated} points since the last flush")
+        if not latest and not tracks:
+            return 0
+
+        # update(), not a merge set: pings are unauthenticated, so an unknown
+        # ID must not create an employees/ document
+        known, failed = set(), []
+        for chunk in chunked(list(latest.items()), 500):
+            written_ids, failed_pairs = self._write_locations(chunk)
+            known.update(written_ids)
+            failed.extend(failed_pairs)
+        written = len(known)
+
+        # Tracks follow their employee: written with it, retried with it, or
+        # dropped with an unknown ID
+        failed_ids = {user_id for user_id, _ in failed}
+        retry_tracks = {key: points for key, points in tracks.items() if key[0] in failed_ids}
+        track_items = [(key, points) for key, points in tracks.items() if key[0] in known]
+        for chunk in chunked(track_items, 500):
+            batch = db.batch()
+            for (user_id, bucket), points in chunk:
+                batch.set(
+                    db.collection("locationTracks").document(f"{user_id}_{bucket}"),
+                    {"userId": user_id, "bucket": bucket, "points": firestore.ArrayUnion(points)},
+                    merge=True
+                )
+            try:
+                batch.commit()
+                written += len(chunk)
+            except Exception as e:
+                self.stats["failures"] += 1
+                retry_tracks.update(chunk)
+                logger.error(f"[Location] Flush of {len(chunk)} track writes failed, requeued: {e}")
+
+        if failed or retry_tracks:
+            self._requeue(failed, retry_tracks)
+
+        self.stats["flushes"] += 1
+        self.stats["writes"] += written
+        logger.info(f"[Location] Flushed {len(latest)} locations and {len(tracks)} track buckets")
+        return written
+
+    def _write_locations(self, chunk: List[tuple]) -> tuple:
+        """
+        Updates lastKnownLocation for (user_id, fix) pairs. Returns the user
+        IDs written and the pairs whose write failed, for the caller to
+        requeue; pairs for unknown employees are in neither.
+        """
+        def commit(pairs) -> None:
+            batch = db.batch()
+            for user_id, fix in pairs:
+                batch.update(db.collection("employees").document(user_id), {"lastKnownLocation": fix})
+            batch.commit()
+
+        pairs = chunk
+        try:
+            commit(pairs)
+            return [user_id for user_id, _ in pairs], []
+        except NotFound:
+            # One unknown employee fails the whole batch: keep the ones that exist and retry
+            try:
+                refs = [db.collection("employees").document(user_id) for user_id, _ in chunk]
+                existing = {snap.id for snap in db.get_all(refs, field_paths=[]) if snap.exists}
+                pairs = [(user_id, fix) for user_id, fix in chunk if user_id in existing]
+                self.stats["unknown"] += len(chunk) - len(pairs)
+                if pairs:
+                    commit(pairs)
+                return [user_id for user_id, _ in pairs], []
+            except Exception as e:
+                logger.error(f"[Location] Retry of {len(pairs)} location writes failed, requeued: {e}")
+        except Exception as e:
+            logger.error(f"[Location] Flush of {len(chunk)} location writes failed, requeued: {e}")
+        self.stats["failures"] += 1
+        return [], list(pairs)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"[Location] Flush loop error: {e}")
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="location-flush", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval)
+        self.flush()
+        if self.pending():
+            logger.warning(f"[Location] Shut down with {self.pending()} failed location writes unflushed")
+
+
+location_ingestor = LocationIngestor(
+    flush_interval=float(os.getenv("LOCATION_FLUSH_SECONDS", "30")),
+    max_pending=int(os.getenv("LOCATION_MAX_PENDING", "10000"))
+)
+
+
+@app.on_event("startup")
+def start_location_ingestor():
+    location_ingestor.start()
+
+
+@app.on_event("shutdown")
+def stop_location_ingestor():
+    location_ingestor.stop()
+
+
+@app.post("/mobile/location/pings", status_code=202)
+def ingest_location_pings(payload: LocationPingBatch, response: Response):
+    now_str = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    accepted = 0
+    rejected = []
+
+    for ping in payload.pings:
+        recorded_at = now_str
+        if ping.recordedAt:
+            try:
+                recorded_at = parse_shift_utc(ping.recordedAt).isoformat().replace("+00:00", "Z")
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"Invalid recordedAt: {ping.recordedAt}")
+
+        if location_ingestor.submit(ping.userId, ping.lat, ping.lng, recorded_at):
+            accepted += 1
+        else:
+            rejected.append(ping.userId)
+
+    if rejected:
+        # Buffer is full: ask the client to retry the rejected pings after the next flush
+        response.headers["Retry-After"] = str(int(location_ingestor.flush_interval))
+
+    return {"success": not rejected, "accepted": accepted, "rejected": rejected}
+
+
+@app.get("/dev/location/stats")
+def location_ingestor_stats():
+    return {"pending": location_ingestor.pending(), **location_ingestor.stats}
+
+
 ##########################################
 #mobile api for screens
 ##########################################
@@ -1983,16 +3750,17 @@ def get_mobile_home(employee_id: str = Query(...)):
     agency_id = employee.get("agencyId")
 
     # 🔍 2. Today’s shift
-    shifts = db.collection("shifts") \
-        .where("employeeId", "==", employee_id) \
-        .where("siteId", "==", site_id) \
-        .where("agencyId", "==", agency_id).stream()
+    shifts = iter_shifts_by_date(
+        today, today,
+        agency_id=agency_id, employee_id=employee_id, site_id=site_id
+    )
 
     current_shift = None
     next_shift = None
 
-    # Preload site name once
-    site_name = get_document_by_id("sites", site_id).get("name", "Unknown")
+    # Preload site name and geofence once
+    site, site_geofence = geofence_cache.get_site(site_id)
+    site_name = site.get("name", "Unknown")
 
     # Get today's attendance record
     start_time = datetime.combine(today, datetime.min.time()).isoformat() + "Z"
@@ -2008,8 +3776,7 @@ def get_mobile_home(employee_id: str = Query(...)):
     clocked_in = any(attendance_today)
     has_clocked_out = any(a.to_dict().get("clockOut") for a in attendance_today)
 
-    for shift_doc in shifts:
-        shift = shift_doc.to_dict()
+    for shift in shifts:
         start = safe_parse_datetime(shift.get("shiftStart"))
         end = safe_parse_datetime(shift.get("shiftEnd"))
         if not start or not end:
@@ -2038,10 +3805,8 @@ def get_mobile_home(employee_id: str = Query(...)):
     geofence_status = "outside"
     lat = employee.get("lat")
     lng = employee.get("lng")
-    coordinates = get_document_by_id("sites", site_id).get("coordinates", [])
-
-    if lat and lng and coordinates:
-        inside = is_inside_geofence(lat, lng, coordinates)
+    if lat and lng and site_geofence.valid:
+        inside = site_geofence.contains(lat, lng)
         geofence_status = "inside" if inside else "outside"
 
     # 🕘 4. Recent Activity
@@ -2084,89 +3849,234 @@ def get_mobile_home(employee_id: str = Query(...)):
 ##############
 #dashboard
 ###############
-@app.get("/v1/dashboard/metrics")
-def get_dashboard_metrics(agency_id: str = Query(...)):
-    try:
-        # Load site metadata to map siteId → siteName
-        sites = db.collection("sites").where("agencyId", "==", agency_id).stream()
-        site_name_map = {s.id: s.to_dict().get("name", s.id) for s in sites}
+# Bumped whenever the document layout changes, so older documents are reconciled on read
+DASHBOARD_METRICS_VERSION = 2
+
+def dashboard_metrics_ref(agency_id: str):
+    return db.collection("dashboardMetrics").document(agency_id)
+
+
+def dashboard_layout_is_legacy(materialized: dict) -> bool:
+    """Reconciled under an older DASHBOARD_METRICS_VERSION. Write-path merges never set version."""
+    return bool(materialized.get("reconciledAt")) and materialized.get("version") != DASHBOARD_METRICS_VERSION
+
+
+def bump_dashboard_metrics(
+    agency_id: str,
+    site_id: Optional[str],
+    employees: int = 0,
+    on_duty: int = 0,
+    reports: int = 0,
+    on_duty_date: Optional[str] = None,
+    batch=None
+) -> None:
+    """
+    Keeps the materialized per-site counters current from the write paths.
+    onDuty is kept per clock-in date (on_duty_date, default today UTC), so a
+    record that is never closed stops counting when the day ends. These
+    merges never set reconciledAt; see get_dashboard_metrics.
+    """
+    if not agency_id or not site_id:
+        return
 
-        # Group employees by assignedsiteID
-        employees = db.collection("employees").where("agencyId", "==", agency_id).stream()
-        site_employees = {}
-        all_employees = []
+    counters = {}
+    if employees:
+        counters["employees"] = firestore.Increment(employees)
+    if on_duty:
+        day = on_duty_date or datetime.utcnow().date().isoformat()
+        counters["onDuty"] = {day: firestore.Increment(on_duty)}
+    if reports:
+        counters["reports"] = firestore.Increment(reports)
+    if not counters:
+        return
 
-        for doc in employees:
-            data = doc.to_dict()
-            site_id = data.get("assignedsiteID")  # ✅ Correct field
-            if not site_id:
-                continue
-            site_employees.setdefault(site_id, []).append(doc.id)
-            all_employees.append(doc.id)
+    changes = {
+        "sites": {site_id: counters},
+        "totals": copy.deepcopy(counters),
+        "updatedAt": datetime.utcnow().isoformat() + "Z"
+    }
+    ref = dashboard_metrics_ref(agency_id)
+    if batch is not None:
+        batch.set(ref, changes, merge=True)
+    else:
+        ref.set(changes, merge=True)
 
-        # Group today's attendance by siteId, only include clocked-in AND not clocked-out
-        today = datetime.utcnow().date().isoformat()
-        attendance = db.collection("attendance").where("agencyId", "==", agency_id).stream()
-        site_attendance = {}
-        all_attendance = []
 
-        for doc in attendance:
-            data = doc.to_dict()
-            clock_in = data.get("clockIn", "")
-            clock_out = data.get("clockOut")
+def set_dashboard_site_name(agency_id: str, site_id: str, name: Optional[str]) -> None:
+    if agency_id and site_id and name:
+        dashboard_metrics_ref(agency_id).set({"sites": {site_id: {"siteName": name}}}, merge=True)
 
-            if not clock_in or not clock_in.startswith(today):
-                continue
-            if clock_out:  # ✅ Exclude those who have clocked out
-                continue
 
-            site_id = data.get("siteId")
-            if not site_id:
-                continue
+def drop_dashboard_site(agency_id: str, site_id: str) -> None:
+    """Removes a deleted site's entry and takes its counters back out of the totals."""
+    ref = dashboard_metrics_ref(agency_id)
+    doc = ref.get()
+    site = ((doc.to_dict() or {}).get("sites") or {}).get(site_id) if doc.exists else None
+    if site is None:
+        return
+
+    totals = {key: firestore.Increment(-site[key]) for key in ("employees", "reports") if site.get(key)}
+    on_duty = site.get("onDuty") if isinstance(site.get("onDuty"), dict) else {}
+    if any(on_duty.values()):
+        totals["onDuty"] = {day: firestore.Increment(-count) for day, count in on_duty.items() if count}
+    ref.set({
+        "sites": {site_id: firestore.DELETE_FIELD},
+        "totals": totals,
+        "updatedAt": datetime.utcnow().isoformat() + "Z"
+    }, merge=True)
 
-            site_attendance.setdefault(site_id, []).append(data)
-            all_attendance.append(data)
 
-        # Group hourly reports by siteId
-        reports = db.collection("hourlyReports").where("agencyId", "==", agency_id).stream()
-        site_reports = {}
-        all_reports = []
+def reconcile_dashboard_metrics(agency_id: str) -> dict:
+    """
+    Recomputes the materialized metrics document from raw data, fixing any
+    drift. Streams every employee and the agency's whole hourlyReports
+    history, so it runs from the scheduled /dev endpoint or a background
+    task, never inline in a dashboard read.
 
-        for doc in reports:
-            data = doc.to_dict()
-            site_id = data.get("siteId")
-            if not site_id:
-                continue
-            site_reports[site_id] = site_reports.get(site_id, 0) + 1
-            all_reports.append(data)
+    The result is written as Increment(recomputed - stored) merges rather
+    than a blind set, so deltas that write paths merge in between the read
+    below and the commit are kept on top of the corrected value.
+    """
+    site_metrics = {}
 
-        # Aggregate per siteId
-        site_ids = set(site_employees.keys()) | set(site_attendance.keys()) | set(site_reports.keys())
-        metrics = {}
+    today = datetime.utcnow().date().isoformat()
 
-        for site_id in site_ids:
-            emp_count = len(site_employees.get(site_id, []))
-            att_count = len(site_attendance.get(site_id, []))
-            rep_count = site_reports.get(site_id, 0)
+    sites = db.collection("sites").where("agencyId", "==", agency_id).select(["name"]).stream()
+    for s in sites:
+        site_metrics[s.id] = {"employees": 0, "onDuty": 0, "reports": 0, "siteName": s.to_dict().get("name", s.id)}
+
+    # Deleted sites drop out of the dashboard, as delete_site removes their entry
+    employees = db.collection("employees").where("agencyId", "==", agency_id).select(["assignedsiteID"]).stream()
+    for doc in employees:
+        site_id = doc.to_dict().get("assignedsiteID")
+        if site_id in site_metrics:
+            site_metrics[site_id]["employees"] += 1
+
+    # On duty: clocked in today and not clocked out
+    attendance = db.collection("attendance") \
+        .where("agencyId", "==", agency_id) \
+        .where("clockIn", ">=", today) \
+        .select(["siteId", "clockOut"]) \
+        .stream()
+    for doc in attendance:
+        data = doc.to_dict()
+        if data.get("siteId") in site_metrics and not data.get("clockOut"):
+            site_metrics[data["siteId"]]["onDuty"] += 1
+
+    reports = db.collection("hourlyReports").where("agencyId", "==", agency_id).select(["siteId"]).stream()
+    for doc in reports:
+        site_id = doc.to_dict().get("siteId")
+        if site_id in site_metrics:
+            site_metrics[site_id]["reports"] += 1
+
+    totals = {key: sum(m[key] for m in site_metrics.values()) for key in ("employees", "onDuty", "reports")}
+
+    stored_doc = dashboard_metrics_ref(agency_id).get()
+    stored = stored_doc.to_dict() if stored_doc.exists else {}
+    if dashboard_layout_is_legacy(stored):
+        # Cleared first so keys from the old layout cannot linger next to the new ones
+        dashboard_metrics_ref(agency_id).delete()
+        stored = {}
+
+    def corrections(counts: dict, current: dict) -> dict:
+        current_on_duty = current.get("onDuty") if isinstance(current.get("onDuty"), dict) else {}
+        on_duty = {day: firestore.DELETE_FIELD for day in current_on_duty if day != today}
+        on_duty[today] = firestore.Increment(counts["onDuty"] - (current_on_duty.get(today) or 0))
+        return {
+            "employees": firestore.Increment(counts["employees"] - (current.get("employees") or 0)),
+            "reports": firestore.Increment(counts["reports"] - (current.get("reports") or 0)),
+            "onDuty": on_duty,
+        }
+
+    stored_sites = stored.get("sites") or {}
+    site_changes = {site_id: firestore.DELETE_FIELD for site_id in stored_sites if site_id not in site_metrics}
+    for site_id, counts in site_metrics.items():
+        site_changes[site_id] = {**corrections(counts, stored_sites.get(site_id) or {}), "siteName": counts["siteName"]}
+
+    now = datetime.utcnow().isoformat() + "Z"
+    changes = {
+        "agencyId": agency_id,
+        "sites": site_changes,
+        "totals": corrections(totals, stored.get("totals") or {}),
+        "updatedAt": now,
+        "reconciledAt": now,
+        "version": DASHBOARD_METRICS_VERSION
+    }
+    dashboard_metrics_ref(agency_id).set(changes, merge=True)
+    logger.info(f"Reconciled dashboard metrics for agency {agency_id}")
+
+    return {
+        "sites": {site_id: {**counts, "onDuty": {today: counts["onDuty"]}} for site_id, counts in site_metrics.items()},
+        "totals": {**totals, "onDuty": {today: totals["onDuty"]}},
+        "reconciledAt": now,
+    }
+
+
+@app.post("/dev/metrics/dashboard/reconcile")
+def run_dashboard_reconciliation(agency_id: Optional[str] = Query(None, description="Defaults to every agency")):
+    """
+    Drift repair for the materialized dashboard counters. Meant to be called
+    daily by an external scheduler (e.g. Cloud Scheduler), once per
+    deployment rather than once per worker.
+    """
+    agency_ids = [agency_id] if agency_id else [doc.id for doc in db.collection("agencies").select([]).stream()]
+    for a_id in agency_ids:
+        reconcile_dashboard_metrics(a_id)
+    return {"success": True, "reconciled": len(agency_ids)}
+
+
+@app.get("/v1/dashboard/metrics")
+def get_dashboard_metrics(background_tasks: BackgroundTasks, agency_id: str = Query(...)):
+    try:
+        # Reads never reconcile inline: that scans the agency's whole history.
+        # A document that has never been reconciled at the current layout
+        # only holds the deltas merged since it was created, so one reconcile
+        # is queued in the background and reconciledAt tells the client the
+        # counters are not yet complete. onDuty is keyed by date, so older
+        # days simply stop counting without a reconcile.
+        today = datetime.utcnow().date().isoformat()
+        doc = dashboard_metrics_ref(agency_id).get()
+        materialized = doc.to_dict() if doc.exists else {}
+        legacy = dashboard_layout_is_legacy(materialized)
+        if legacy or not materialized.get("reconciledAt"):
+            queue_background_once(background_tasks, ("dashboard", agency_id), reconcile_dashboard_metrics, agency_id)
+        if legacy:
+            materialized = {}
+
+        def on_duty_today(counters: dict) -> int:
+            on_duty = counters.get("onDuty")
+            return on_duty.get(today, 0) if isinstance(on_duty, dict) else 0
+
+        metrics = {}
+        for site_id, site in materialized.get("sites", {}).items():
+            emp_count = max(site.get("employees", 0), 0)
+            att_count = max(on_duty_today(site), 0)
+            rep_count = max(site.get("reports", 0), 0)
+            if not (emp_count or att_count or rep_count):
+                continue
 
             metrics[site_id] = {
                 "attendancePercentage": round((att_count / emp_count) * 100, 1) if emp_count else 0,
                 "activeOnDuty": att_count,
                 "reports": rep_count,
-                "siteName": site_name_map.get(site_id, "Unnamed Site")
+                "siteName": site.get("siteName", "Unnamed Site")
             }
 
         # Add global summary under "all"
+        totals = materialized.get("totals", {})
+        total_employees = max(totals.get("employees", 0), 0)
+        total_on_duty = max(on_duty_today(totals), 0)
         metrics["all"] = {
-            "attendancePercentage": round((len(all_attendance) / len(all_employees)) * 100, 1) if all_employees else 0,
-            "activeOnDuty": len(all_attendance),
-            "reports": len(all_reports),
+            "attendancePercentage": round((total_on_duty / total_employees) * 100, 1) if total_employees else 0,
+            "activeOnDuty": total_on_duty,
+            "reports": max(totals.get("reports", 0), 0),
             "siteName": "All Sites"
         }
 
         return {
             "success": True,
-            "sites": metrics  # ⬅️ now keyed by siteId
+            "sites": metrics,  # ⬅️ now keyed by siteId
+            "reconciledAt": materialized.get("reconciledAt")
         }
 
     except Exception as e:
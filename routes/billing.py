@@ -1,8 +1,11 @@
 from fastapi import APIRouter, HTTPException, Body, Query
 from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
 from datetime import datetime
+from typing import Optional
 import os
-from config.stripe import stripe, get_stripe_customer_id
+from config.stripe import stripe, stripe_dict, get_stripe_customer_id, prime_stripe_customer_id, StripeLookups
+from config.cache import TTLCache
 from schemas.billing import (
     CreatePortalSessionRequest,
     CreateCheckoutSessionRequest,
@@ -13,18 +16,283 @@ from schemas.billing import (
 
 router = APIRouter(prefix="/billing", tags=["Billing"])
 
-def get_stripe_customer_id(user_id: str) -> str:
+# ---------------------------------------------------------------------------
+# Billing mirror: Stripe state persisted from webhooks, served to read endpoints
+#
+#   billingCustomers/{customerId}                       defaultPaymentMethod, syncedAt
+#   billingCustomers/{customerId}/subscriptions/{id}
+#   billingCustomers/{customerId}/invoices/{id}
+#   billingCustomers/{customerId}/paymentMethods/{id}
+#   stripeEvents/{eventId}                              processed-event marker
+# ---------------------------------------------------------------------------
+
+def _mirror_ref(customer_id: str):
+    from firebase_admin import firestore
+    return firestore.client().collection("billingCustomers").document(customer_id)
+
+
+def _subscription_doc(sub) -> dict:
+    items = (sub.get("items") or {}).get("data") or []
+    price = items[0].get("price") if items else None
+    # Newer API versions report the billing period per subscription item
+    period_end = sub.get("current_period_end") or (items[0].get("current_period_end") if items else None)
+    return {
+        "id": sub["id"],
+        "status": sub.get("status"),
+        "planName": (price or {}).get("nickname") or "Professional",
+        "current_period_end": period_end,
+        "created": sub.get("created"),
+    }
+
+
+def _invoice_doc(inv) -> dict:
+    return {
+        "id": inv["id"],
+        "amount_paid": inv.get("amount_paid") or 0,
+        "currency": inv.get("currency") or "",
+        "status": inv.get("status"),
+        "created": inv.get("created"),
+        "hosted_invoice_url": inv.get("hosted_invoice_url"),
+        "invoice_pdf": inv.get("invoice_pdf"),
+    }
+
+
+def _payment_method_doc(pm) -> dict:
+    card = pm.get("card") or {}
+    return {
+        "id": pm["id"],
+        "brand": card.get("brand"),
+        "last4": card.get("last4"),
+        "exp_month": card.get("exp_month"),
+        "exp_year": card.get("exp_year"),
+        "created": pm.get("created"),
+    }
+
+
+def _upsert(customer_id: str, subcollection: str, doc: dict, event_created: int = None) -> None:
+    from firebase_admin import firestore
+    ref = _mirror_ref(customer_id).collection(subcollection).document(doc["id"])
+
+    @firestore.transactional
+    def write(transaction):
+        # Stripe does not guarantee delivery order: never let an older event win
+        snapshot = ref.get(transaction=transaction)
+        stored = snapshot.to_dict() if snapshot.exists else {}
+        if event_created and (stored.get("eventCreated") or 0) > event_created:
+            return
+        transaction.set(ref, {**doc, "eventCreated": event_created})
+
+    write(firestore.client().transaction())
+
+
+# Short-lived invoice pages keyed (customerId, limit, starting_after, gte, lte);
+# dropped for a customer whenever their invoices change
+invoice_page_cache = TTLCache(max_entries=2000, ttl_seconds=60)
+
+INVOICE_PAGE_MAX = 100
+
+
+def _invoice_row(inv: dict) -> dict:
+    return {
+        "id": inv["id"],
+        "amount": (inv.get("amount_paid") or 0) / 100,
+        "currency": (inv.get("currency") or "").upper(),
+        "status": inv.get("status"),
+        "created": datetime.fromtimestamp(inv["created"]).isoformat(),
+        "hosted_invoice_url": inv.get("hosted_invoice_url"),
+        "invoice_pdf": inv.get("invoice_pdf")
+    }
+
+
+def list_invoice_page(
+    customer_id: str,
+    limit: int = 10,
+    starting_after: Optional[str] = None,
+    created_gte: Optional[int] = None,
+    created_lte: Optional[int] = None
+) -> dict:
+    """
+    One page of invoices, newest first. Served from the mirror once it has
+    been synced, otherwise with a single Stripe list call; this never
+    triggers the full-history backfill that ensure_billing_mirror runs.
+    """
+    key = (customer_id, limit, starting_after, created_gte, created_lte)
+    page = invoice_page_cache.get(key)
+    if page is not None:
+        return page
+
+    mirror = _mirror_ref(customer_id).get()
+    if mirror.exists and mirror.to_dict().get("syncedAt"):
+        from firebase_admin import firestore
+        invoices = _mirror_ref(customer_id).collection("invoices")
+        query = invoices.order_by("created", direction=firestore.Query.DESCENDING)
+        if created_gte is not None:
+            query = query.where("created", ">=", created_gte)
+        if created_lte is not None:
+            query = query.where("created", "<=", created_lte)
+        if starting_after:
+            cursor = invoices.document(starting_after).get()
+            if not cursor.exists:
+                raise HTTPException(status_code=400, detail="Unknown starting_after invoice")
+            query = query.start_after(cursor)
+
+        rows = [doc.to_dict() for doc in query.limit(limit + 1).stream()]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        params = {"customer": customer_id, "limit": limit}
+        if starting_after:
+            params["starting_after"] = starting_after
+        created = {k: v for k, v in (("gte", created_gte), ("lte", created_lte)) if v is not None}
+        if created:
+            params["created"] = created
+
+        result = stripe.Invoice.list(**params)
+        rows = [_invoice_doc(stripe_dict(inv)) for inv in result.data]
+        has_more = result.has_more
+
+    page = {
+        "invoices": [_invoice_row(inv) for inv in rows],
+        "hasMore": has_more,
+        "nextCursor": rows[-1]["id"] if rows and has_more else None
+    }
+    invoice_page_cache.set(key, page)
+    return page
+
+
+def invalidate_invoice_pages(customer_id: str) -> None:
+    invoice_page_cache.pop_matching(lambda key: key[0] == customer_id)
+
+
+def _event_processed(event_id: str) -> bool:
+    from firebase_admin import firestore
+    return firestore.client().collection("stripeEvents").document(event_id).get(field_paths=[]).exists
+
+
+def _mark_event_processed(event_id: str) -> None:
+    """
+    Written only after the event has been applied, so a crash in between
+    leaves it unmarked and Stripe's retry applies it again. Applying twice
+    is harmless: upserts are ordered by eventCreated and deletes are
+    idempotent.
+    """
+    from firebase_admin import firestore
+    firestore.client().collection("stripeEvents").document(event_id).set({
+        "processedAt": datetime.utcnow().isoformat() + "Z"
+    })
+
+
+# Card events whose object is the current state of a customer's card;
+# automatically_updated is the card updater changing expiry or number
+PAYMENT_METHOD_EVENTS = {
+    "payment_method.attached",
+    "payment_method.updated",
+    "payment_method.automatically_updated",
+}
+
+# Invoice events that carry a persisted invoice. invoice.upcoming previews a
+# draft that has no ID yet, so it is deliberately left out.
+INVOICE_EVENTS = {
+    "invoice.created",
+    "invoice.finalized",
+    "invoice.updated",
+    "invoice.paid",
+    "invoice.payment_succeeded",
+    "invoice.payment_failed",
+    "invoice.payment_action_required",
+    "invoice.marked_uncollectible",
+    "invoice.voided",
+}
+
+
+def apply_billing_event(event) -> None:
+    event_type = event["type"]
+    obj = event["data"]["object"]
+    created = event.get("created")
+
+    if event_type in INVOICE_EVENTS and obj.get("id"):
+        _upsert(obj["customer"], "invoices", _invoice_doc(obj), created)
+        invalidate_invoice_pages(obj["customer"])
+
+    elif event_type == "invoice.deleted" and obj.get("id"):
+        # Only drafts can be deleted
+        _mirror_ref(obj["customer"]).collection("invoices").document(obj["id"]).delete()
+        invalidate_invoice_pages(obj["customer"])
+
+    elif event_type.startswith("customer.subscription."):
+        _upsert(obj["customer"], "subscriptions", _subscription_doc(obj), created)
+
+    elif event_type in PAYMENT_METHOD_EVENTS and obj.get("customer"):
+        _upsert(obj["customer"], "paymentMethods", _payment_method_doc(obj), created)
+
+    elif event_type == "payment_method.detached":
+        # The detached object no longer carries its customer
+        previous = event["data"].get("previous_attributes") or {}
+        customer_id = obj.get("customer") or previous.get("customer")
+        if customer_id:
+            _mirror_ref(customer_id).collection("paymentMethods").document(obj["id"]).delete()
+
+    elif event_type == "customer.updated":
+        settings = obj.get("invoice_settings") or {}
+        _mirror_ref(obj["id"]).set({
+            "customerId": obj["id"],
+            "defaultPaymentMethod": settings.get("default_payment_method"),
+        }, merge=True)
+
+
+def reconcile_billing_customer(customer_id: str, lookups: Optional[StripeLookups] = None) -> dict:
+    """Backfills one customer's mirror from Stripe's list APIs."""
     from firebase_admin import firestore
     db = firestore.client()
-    user_ref = db.collection("users").document(user_id)
-    user_doc = user_ref.get()
-    if not user_doc.exists:
-        raise HTTPException(status_code=404, detail="User not found")
+    mirror = _mirror_ref(customer_id)
+    lookups = lookups or StripeLookups()
+
+    # The four reads are independent, so they share the wall-clock of the slowest
+    fetched = lookups.fetch(
+        customer=lambda: lookups.customer(customer_id),
+        subscriptions=lambda: [_subscription_doc(stripe_dict(s)) for s in stripe.Subscription.list(customer=customer_id, status="all", limit=100).auto_paging_iter()],
+        invoices=lambda: [_invoice_doc(stripe_dict(i)) for i in stripe.Invoice.list(customer=customer_id, limit=100).auto_paging_iter()],
+        methods=lambda: [_payment_method_doc(stripe_dict(p)) for p in stripe.PaymentMethod.list(customer=customer_id, type="card", limit=100).auto_paging_iter()],
+    )
+    customer = fetched["customer"]
+    subscriptions, invoices, methods = fetched["subscriptions"], fetched["invoices"], fetched["methods"]
+
+    writes = [(mirror.collection("subscriptions").document(d["id"]), d) for d in subscriptions]
+    writes += [(mirror.collection("invoices").document(d["id"]), d) for d in invoices]
+    writes += [(mirror.collection("paymentMethods").document(d["id"]), d) for d in methods]
+
+    # Cards removed while webhooks were missed
+    live_methods = {d["id"] for d in methods}
+    stale = [doc.reference for doc in mirror.collection("paymentMethods").stream() if doc.id not in live_methods]
+
+    for i in range(0, max(len(writes), len(stale), 1), 500):
+        batch = db.batch()
+        for ref, data in writes[i:i + 500]:
+            batch.set(ref, data, merge=True)
+        for ref in stale[i:i + 500]:
+            batch.delete(ref)
+        batch.commit()
+
+    invalidate_invoice_pages(customer_id)
+
+    settings = customer.get("invoice_settings") or {}
+    mirror.set({
+        "customerId": customer_id,
+        "defaultPaymentMethod": settings.get("default_payment_method"),
+        "syncedAt": datetime.utcnow().isoformat() + "Z",
+    }, merge=True)
+
+    return {"subscriptions": len(subscriptions), "invoices": len(invoices), "paymentMethods": len(methods)}
+
+
+def ensure_billing_mirror(customer_id: str):
+    """Mirror document for the customer, backfilling it on first use."""
+    snapshot = _mirror_ref(customer_id).get()
+    if not snapshot.exists or not snapshot.to_dict().get("syncedAt"):
+        reconcile_billing_customer(customer_id)
+        snapshot = _mirror_ref(customer_id).get()
+    return snapshot.to_dict()
 
-    customer_id = user_doc.to_dict().get("stripeCustomerId")
-    if not customer_id:
-        raise HTTPException(status_code=404, detail="Stripe customer ID not found")
-    return customer_id
 
 @router.post("/create-portal-session")
 def create_portal_session(payload: CreatePortalSessionRequest):
@@ -111,67 +379,84 @@ async def stripe_webhook(request: Request):
     except stripe.error.SignatureVerificationError:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    # 🔄 Handle events
-    if event["type"] == "invoice.paid":
-        invoice = event["data"]["object"]
-        # update Firestore, mark invoice paid, etc.
+    event = stripe_dict(event)
 
-    elif event["type"] == "customer.subscription.updated":
-        subscription = event["data"]["object"]
-        # update subscription status or features
+    # 🔄 Mirror the event into Firestore, once per event ID
+    if await run_in_threadpool(_event_processed, event["id"]):
+        return {"status": "duplicate"}
 
-    elif event["type"] == "customer.subscription.deleted":
-        subscription = event["data"]["object"]
-        # handle downgrade or cancellation
+    try:
+        await run_in_threadpool(apply_billing_event, event)
+        await run_in_threadpool(_mark_event_processed, event["id"])
+    except Exception as e:
+        # Unmarked, so Stripe's retry processes it again
+        raise HTTPException(status_code=500, detail=f"Failed to process event: {str(e)}")
 
     return {"status": "success"}
 
+
+@router.post("/mirror/reconcile")
+def reconcile_billing_mirror(userId: Optional[str] = Query(None)):
+    try:
+        from firebase_admin import firestore
+        if userId:
+            customer_ids = [get_stripe_customer_id(userId)]
+        else:
+            users = firestore.client().collection("users").where("stripeCustomerId", "!=", None).select(["stripeCustomerId"]).stream()
+            customer_ids = []
+            for u in users:
+                customer_id = u.to_dict()["stripeCustomerId"]
+                prime_stripe_customer_id(u.id, customer_id)
+                customer_ids.append(customer_id)
+
+        lookups = StripeLookups()
+        results = {customer_id: reconcile_billing_customer(customer_id, lookups) for customer_id in customer_ids}
+        return {"success": True, "customers": results}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to reconcile billing mirror: {str(e)}")
+
 @router.get("/invoices")
-def get_invoices(userId: str = Query(...)):
+def get_invoices(
+    userId: str = Query(...),
+    limit: int = Query(10, ge=1, le=INVOICE_PAGE_MAX),
+    starting_after: Optional[str] = Query(None, description="Invoice ID from the previous page's nextCursor"),
+    created_gte: Optional[int] = Query(None, description="Unix timestamp"),
+    created_lte: Optional[int] = Query(None, description="Unix timestamp")
+):
     try:
         customer_id = get_stripe_customer_id(userId)
-        invoices = stripe.Invoice.list(customer=customer_id, limit=10)
-
-        return {
-            "success": True,
-            "invoices": [
-                {
-                    "id": inv.id,
-                    "amount": inv.amount_paid / 100,
-                    "currency": inv.currency.upper(),
-                    "status": inv.status,
-                    "created": datetime.fromtimestamp(inv.created).isoformat(),
-                    "hosted_invoice_url": inv.hosted_invoice_url,
-                    "invoice_pdf": inv.invoice_pdf
-                }
-                for inv in invoices.auto_paging_iter()
-            ]
-        }
+        page = list_invoice_page(customer_id, limit, starting_after, created_gte, created_lte)
+        return {"success": True, **page}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch invoices: {str(e)}")
     
 @router.get("/payment-methods")
-async def get_payment_methods(userId: str):
+def get_payment_methods(userId: str):
     try:
+        from firebase_admin import firestore
         customer_id = get_stripe_customer_id(userId)
-        payment_methods = stripe.PaymentMethod.list(
-            customer=customer_id,
-            type="card"
-        )
+        mirror = ensure_billing_mirror(customer_id)
+        default_method = mirror.get("defaultPaymentMethod")
+        payment_methods = _mirror_ref(customer_id).collection("paymentMethods") \
+            .order_by("created", direction=firestore.Query.DESCENDING) \
+            .stream()
 
         return {
             "success": True,
             "methods": [
                 {
-                    "brand": pm.card.brand,
-                    "last4": pm.card.last4,
-                    "exp_month": pm.card.exp_month,
-                    "exp_year": pm.card.exp_year,
-                    "id": pm.id,
-                    "isDefault": pm.id == stripe.Customer.retrieve(customer_id).invoice_settings.default_payment_method
+                    "brand": pm["brand"],
+                    "last4": pm["last4"],
+                    "exp_month": pm["exp_month"],
+                    "exp_year": pm["exp_year"],
+                    "id": pm["id"],
+                    "isDefault": pm["id"] == default_method
                 }
-                for pm in payment_methods["data"]
+                for pm in (doc.to_dict() for doc in payment_methods)
             ]
         }
     except Exception as e:
@@ -233,36 +518,40 @@ def purchase_site(userId: str = Body(...), quantity: int = Body(...)):
 
 
 @router.get("/billing/subscription-status")
-async def subscription_status(userId: str = Query(...)):
+def subscription_status(userId: str = Query(...)):
     # your existing logic using userId
 
     try:
+        from firebase_admin import firestore
         customer_id = get_stripe_customer_id(userId)
+        ensure_billing_mirror(customer_id)
 
-        subscriptions = stripe.Subscription.list(
-            customer=customer_id,
-            status="all",
-            limit=1
+        subscriptions = list(
+            _mirror_ref(customer_id).collection("subscriptions")
+            .order_by("created", direction=firestore.Query.DESCENDING)
+            .limit(1)
+            .stream()
         )
 
-        if not subscriptions.data:
+        if not subscriptions:
             return {
                 "subscribed": False,
                 "planName": None,
                 "renewalDate": None
             }
 
-        subscription = subscriptions.data[0]
+        subscription = subscriptions[0].to_dict()
 
-        if subscription.status not in ["active", "trialing"]:
+        if subscription["status"] not in ["active", "trialing"]:
             return {
                 "subscribed": False,
                 "planName": None,
                 "renewalDate": None
             }
 
-        plan_name = subscription["items"]["data"][0]["price"].get("nickname", "Professional")
-        renewal_date = datetime.fromtimestamp(subscription.current_period_end).isoformat()
+        plan_name = subscription.get("planName") or "Professional"
+        period_end = subscription.get("current_period_end")
+        renewal_date = datetime.fromtimestamp(period_end).isoformat() if period_end else None
 
         return {
             "subscribed": True,